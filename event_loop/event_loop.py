@@ -20,7 +20,10 @@
 import sys
 import os
 import time
+import errno
+import fcntl
 import itertools
+import collections
 import select
 import decimal
 
@@ -175,6 +178,8 @@ class EventLoop(object):
     def __init__(self):
         self._timers = TimerManager()
         self._readers = {}
+        self._pending_calls = collections.deque()
+        self._wake_up_pipe = None
     
     def add_timer(self, timeout, repeat=False):
         """
@@ -296,6 +301,48 @@ class EventLoop(object):
             return callback
         return decorator
             
+    def threadsafe_callback(self, callback):
+        """
+        Decorator. Return a function that can be called from any thread:
+        the decorated callback is then called with the same arguments in
+        the event loop's own thread, as soon as possible.
+        
+            @loop.threadsafe_callback
+            def hash_done(result):
+                # ...
+            
+            some_thread_pool.apply_async(slow_function, callback=hash_done)
+        
+        This is the only method that other threads may use.
+        """
+        if self._wake_up_pipe is None:
+            self._wake_up_pipe = os.pipe()
+            # Never block the calling thread when the pipe is full: the
+            # pending bytes already wake up the loop.
+            writer = self._wake_up_pipe[1]
+            fcntl.fcntl(writer, fcntl.F_SETFL,
+                        fcntl.fcntl(writer, fcntl.F_GETFL) | os.O_NONBLOCK)
+            
+            @self.watch_for_reading(self._wake_up_pipe[0])
+            def wake_up(fd):
+                os.read(fd, 4096)
+                # Other threads may append while we run, that's fine.
+                while self._pending_calls:
+                    function, args = self._pending_calls.popleft()
+                    function(*args)
+        writer = self._wake_up_pipe[1]
+        
+        def call_soon(*args):
+            # deque.append() is atomic. Writing to the pipe makes select()
+            # in the loop's thread return.
+            self._pending_calls.append((callback, args))
+            try:
+                os.write(writer, 'x')
+            except OSError:
+                if sys.exc_info()[1].errno != errno.EAGAIN:
+                    raise
+        return call_soon
+
     def run(self):
         """
         Run the event loop. Wait for events, call callbacks when events happen,
@@ -12,6 +12,7 @@ import unittest
 import os
 import time
 import logging
+import threading
 from decimal import Decimal
 
 from event_loop import Timer, TimerManager, EventLoop
@@ -488,6 +489,30 @@ class TestEventLoop(unittest.TestCase):
             os.close(writer)
 
 
+class TestThreadsafeCallback(unittest.TestCase):
+    def test_threadsafe_callback(self):
+        loop = EventLoop()
+        results = []
+        
+        @loop.threadsafe_callback
+        def callback(a, b):
+            results.append((a, b, threading.current_thread()))
+            if len(results) == 3:
+                loop.stop()
+        
+        # Fail instead of blocking forever.
+        loop.add_timer(5)(loop.stop)
+        threads = [threading.Thread(target=callback, args=(i, 'foo'))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        loop.run()
+        for thread in threads:
+            thread.join()
+        assert sorted(results) == [
+            (i, 'foo', threading.current_thread()) for i in range(3)]
+
+
 class TestLineReader(unittest.TestCase):
     def test_line_reader(self):
         reader, writer = os.pipe()
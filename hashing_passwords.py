@@ -1,7 +1,7 @@
 # coding: utf8
 """
 
-    Securely hash and check passwords using PBKDF2.
+    Securely hash and check passwords using PBKDF2 or scrypt.
 
     Use random salts to protect againt rainbow tables, many iterations against
     brute-force, and constant-time comparaison againt timing attacks.
@@ -16,51 +16,722 @@
 
 """
 
+from __future__ import division
+import argparse
+import time
+import logging
+import threading
+import multiprocessing
+import multiprocessing.pool
 import hashlib
+import os
+import json
 from os import urandom
 from base64 import b64encode, b64decode
-from itertools import izip
+from collections import OrderedDict, Counter
 
-# From https://github.com/mitsuhiko/python-pbkdf2
-from pbkdf2 import pbkdf2_bin
+try:
+    # From https://github.com/mitsuhiko/python-pbkdf2
+    from pbkdf2 import pbkdf2_bin
+except ImportError:
+    pbkdf2_bin = None
 
+try:
+    text_type = unicode
+except NameError:  # Python 3
+    text_type = str
+
+
+# The scheme for new passwords: 'PBKDF2' or 'SCRYPT'. Existing hashes keep
+# working with either.
+SCHEME = 'PBKDF2'
 
 # Parameters to PBKDF2. Only affect new passwords.
 SALT_LENGTH = 12
 KEY_LENGTH = 24
 HASH_FUNCTION = 'sha256'  # Must be in hashlib.
 # Linear to the hashing time. Adjust to be high but take a reasonable
-# amount of time on your server. Measure with:
-# python -m timeit -s 'import passwords as p' 'p.make_hash("something")'
+# amount of time on your server. Measure and write a config file with:
+# python hashing_passwords.py calibrate --target-ms 50 --write
 COST_FACTOR = 10000
 
+# Parameters to scrypt, also used with SALT_LENGTH and KEY_LENGTH.
+# Each hash uses about 128 * SCRYPT_N * SCRYPT_R bytes of memory (16 MiB
+# here) and a time linear to that. SCRYPT_P multiplies the time but not
+# the memory. Needs Python 3.6+ with OpenSSL 1.1+.
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+# CPython limits hashlib.scrypt()'s maxmem to a C int.
+SCRYPT_MAX_MEMORY = 2 ** 31 - 1
+
+# A JSON file that overrides the parameters above and BACKEND below, as
+# written by calibrate().
+CONFIG_FILE = os.environ.get('HASHING_PASSWORDS_CONFIG', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'hashing_passwords.json'))
+
+
+def _pbkdf2_hashlib(password, salt, cost_factor, key_length, hash_function):
+    return hashlib.pbkdf2_hmac(hash_function, password, salt, cost_factor,
+                               key_length)
+
+
+def _pbkdf2_python(password, salt, cost_factor, key_length, hash_function):
+    return pbkdf2_bin(password, salt, cost_factor, key_length,
+                      getattr(hashlib, hash_function))
+
+
+# PBKDF2 implementations by name, fastest first. They all give the same
+# result. hashlib.pbkdf2_hmac (Python 2.7.8+ and 3.4+) uses OpenSSL, which
+# is much faster and releases the GIL while hashing. (Python 2 built without
+# OpenSSL has a pure-Python fallback, still faster than the pbkdf2 module.)
+BACKENDS = OrderedDict()
+if hasattr(hashlib, 'pbkdf2_hmac'):
+    BACKENDS['hashlib'] = _pbkdf2_hashlib
+if pbkdf2_bin is not None:
+    BACKENDS['python'] = _pbkdf2_python
+assert BACKENDS, 'Needs Python 2.7.8+ or the pbkdf2 module.'
+
+# The implementation used by make_hash() and check_hash().
+BACKEND = next(iter(BACKENDS))
+
+
+def load_config(filename=CONFIG_FILE):
+    """Set the parameters for new hashes from a JSON config file."""
+    global SCHEME, HASH_FUNCTION, COST_FACTOR, BACKEND
+    global SCRYPT_N, SCRYPT_R, SCRYPT_P
+    with open(filename) as file:
+        config = json.load(file)
+    if not isinstance(config, dict):
+        raise ValueError('%s: expected a JSON object' % filename)
+    SCHEME = str(config.get('scheme', SCHEME))
+    HASH_FUNCTION = str(config.get('hash_function', HASH_FUNCTION))
+    COST_FACTOR = int(config.get('cost_factor', COST_FACTOR))
+    n = int(config.get('scrypt_n', SCRYPT_N))
+    r = int(config.get('scrypt_r', SCRYPT_R))
+    p = int(config.get('scrypt_p', SCRYPT_P))
+    if scrypt_memory(n, r, p) > SCRYPT_MAX_MEMORY:
+        raise ValueError('%s: scrypt with n=%i, r=%i, p=%i would need more '
+                         'than 2 GiB of memory' % (filename, n, r, p))
+    SCRYPT_N, SCRYPT_R, SCRYPT_P = n, r, p
+    if config.get('backend') in BACKENDS:
+        BACKEND = str(config['backend'])
+
+if os.path.exists(CONFIG_FILE):
+    load_config()
+
+# Backends that let other threads run while hashing: threads are then
+# enough to hash in parallel.
+GIL_RELEASING_BACKENDS = set()
+if 'hashlib' in BACKENDS and hashlib.pbkdf2_hmac.__module__ == '_hashlib':
+    GIL_RELEASING_BACKENDS.add('hashlib')
+
+
+def pbkdf2(password, salt, cost_factor, key_length, hash_function,
+           backend=None):
+    """
+    Return a PBKDF2 key for the bytes `password` and `salt`, using the
+    `hash_function` name in hashlib. `backend` is a name in `BACKENDS` and
+    defaults to `BACKEND`.
+    """
+    return BACKENDS[backend or BACKEND](
+        password, salt, cost_factor, key_length, hash_function)
+
+
+def scrypt_memory(n, r, p):
+    """Return approximately how many bytes of memory scrypt uses."""
+    return 128 * r * (n + p + 2)
+
+
+def scrypt(password, salt, n, r, p, key_length):
+    """Return a scrypt key for the bytes `password` and `salt`."""
+    assert hasattr(hashlib, 'scrypt'), 'Needs Python 3.6+ and OpenSSL 1.1+'
+    memory = scrypt_memory(n, r, p)
+    if memory > SCRYPT_MAX_MEMORY:
+        raise ValueError('scrypt with n=%i, r=%i, p=%i would need more '
+                         'than 2 GiB of memory' % (n, r, p))
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                          dklen=key_length,
+                          # Leave some room for OpenSSL's own overhead.
+                          maxmem=min(memory + 1024 * 1024, SCRYPT_MAX_MEMORY))
+
 
 def make_hash(password):
     """Generate a random salt and return a new hash for the password."""
-    if isinstance(password, unicode):
+    if isinstance(password, text_type):
         password = password.encode('utf-8')
     salt = b64encode(urandom(SALT_LENGTH))
+    if SCHEME == 'SCRYPT':
+        return 'SCRYPT${}${}${}${}${}'.format(
+            SCRYPT_N, SCRYPT_R, SCRYPT_P,
+            salt.decode('ascii'),
+            b64encode(scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P,
+                             KEY_LENGTH)).decode('ascii'))
+    assert SCHEME == 'PBKDF2'
     return 'PBKDF2${}${}${}${}'.format(
         HASH_FUNCTION,
         COST_FACTOR,
-        salt,
-        b64encode(pbkdf2_bin(password, salt, COST_FACTOR, KEY_LENGTH,
-                             getattr(hashlib, HASH_FUNCTION))))
+        salt.decode('ascii'),
+        b64encode(pbkdf2(password, salt, COST_FACTOR, KEY_LENGTH,
+                         HASH_FUNCTION)).decode('ascii'))
 
 
 def check_hash(password, hash_):
     """Check a password against an existing hash."""
-    if isinstance(password, unicode):
+    if isinstance(password, text_type):
         password = password.encode('utf-8')
-    algorithm, hash_function, cost_factor, salt, hash_a = hash_.split('$')
-    assert algorithm == 'PBKDF2'
-    hash_a = b64decode(hash_a)
-    hash_b = pbkdf2_bin(password, salt, int(cost_factor), len(hash_a),
-                        getattr(hashlib, hash_function))
-    assert len(hash_a) == len(hash_b)  # we requested this from pbkdf2_bin()
+    algorithm = hash_.split('$', 1)[0]
+    if algorithm == 'SCRYPT':
+        algorithm, n, r, p, salt, hash_a = hash_.split('$')
+        hash_a = b64decode(hash_a)
+        hash_b = scrypt(password, salt.encode('ascii'), int(n), int(r),
+                        int(p), len(hash_a))
+    else:
+        algorithm, hash_function, cost_factor, salt, hash_a = (
+            hash_.split('$'))
+        assert algorithm == 'PBKDF2'
+        hash_a = b64decode(hash_a)
+        hash_b = pbkdf2(password, salt.encode('ascii'), int(cost_factor),
+                        len(hash_a), hash_function)
+    assert len(hash_a) == len(hash_b)  # we requested this length
     # Same as "return hash_a == hash_b" but takes a constant time.
     # See http://carlos.bueno.org/2011/10/timing.html
     diff = 0
-    for char_a, char_b in izip(hash_a, hash_b):
-        diff |= ord(char_a) ^ ord(char_b)
+    for char_a, char_b in zip(bytearray(hash_a), bytearray(hash_b)):
+        diff |= char_a ^ char_b
     return diff == 0
+
+
+def _parameters(hash_):
+    """
+    Return the algorithm and parameters of a hash as a list of strings,
+    without the salt and key.
+    """
+    return hash_.split('$')[:-2]
+
+
+def _current_parameters():
+    if SCHEME == 'SCRYPT':
+        return ['SCRYPT', str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)]
+    return ['PBKDF2', HASH_FUNCTION, str(COST_FACTOR)]
+
+
+def needs_update(hash_):
+    """
+    Return whether an existing hash was made with other parameters than
+    the current ones, and should be replaced by a new hash next time the
+    password is known.
+    
+    The PBKDF2 backend does not appear in hashes since they all give the
+    same result, so only the scheme, its parameters (hash function and
+    cost factor, or scrypt's n, r and p) and the key length are compared.
+    """
+    return (_parameters(hash_) != _current_parameters() or
+            len(b64decode(hash_.split('$')[-1])) != KEY_LENGTH)
+
+
+def verify_and_update(password, hash_):
+    """
+    Check a password against an existing hash, and return a (valid,
+    new_hash) tuple. `new_hash` is None unless the password is valid and
+    the hash `needs_update()`, in which case it should be stored instead
+    of the old one. This migrates hashes to new parameters as users log in.
+    """
+    if not check_hash(password, hash_):
+        return False, None
+    if needs_update(hash_):
+        return True, make_hash(password)
+    return True, None
+
+
+def _timed_check(args):
+    """
+    Run check_hash() in a worker process unless `deadline` has passed.
+    Return (result, error message, start time, end time).
+    """
+    password, hash_, deadline = args
+    start = time.time()
+    if deadline is not None and start > deadline:
+        return None, None, start, start
+    try:
+        result, error = check_hash(password, hash_), None
+    except Exception as exc:
+        result, error = False, '%s: %s' % (type(exc).__name__, exc)
+    return result, error, start, time.time()
+
+
+class Overloaded(Exception):
+    """Raised when a VerificationPool already has too many queued checks."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a check was not started before its deadline."""
+
+
+class VerificationPool(object):
+    """
+    A long-lived pool of `processes` worker processes (one per CPU by
+    default) that run check_hash() in parallel.
+    
+    At most `max_queued` checks (four per process by default) can be
+    waiting or running at the same time. Beyond that, new checks are shed:
+    `submit()` and `check()` raise `Overloaded` right away rather than
+    making every login slower. Checks with a `timeout` that are still
+    queued when it expires are skipped by the workers.
+    
+    `stats()` gives the queue depth and the average wait and hash times.
+    """
+    def __init__(self, processes=None, max_queued=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_queued = max_queued or 4 * self.processes
+        self._pool = multiprocessing.Pool(self.processes)
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._counters = dict.fromkeys([
+            'submitted', 'completed', 'shed', 'expired', 'errors',
+            'wait_time', 'max_wait_time', 'hash_time'], 0)
+
+    def _record(self, submitted, timed_result):
+        result, error, start, end = timed_result
+        if error is not None:
+            logging.error('check_hash() failed: %s', error)
+        counters = self._counters
+        with self._lock:
+            self._depth -= 1
+            counters['completed'] += 1
+            if result is None:
+                counters['expired'] += 1
+            if error is not None:
+                counters['errors'] += 1
+            counters['wait_time'] += start - submitted
+            counters['max_wait_time'] = max(
+                counters['max_wait_time'], start - submitted)
+            counters['hash_time'] += end - start
+        return result
+
+    def submit(self, password, hash_, callback, timeout=None):
+        """
+        Queue a password check and return immediately. `callback` is later
+        called from another thread with True or False, or with None if
+        `timeout` seconds passed before a worker was available.
+        
+        Errors in check_hash(), eg. for malformed hashes, are logged and
+        count as a failed check.
+        """
+        with self._lock:
+            if self._depth >= self.max_queued:
+                self._counters['shed'] += 1
+                raise Overloaded
+            self._depth += 1
+            self._counters['submitted'] += 1
+        submitted = time.time()
+        deadline = None if timeout is None else submitted + timeout
+
+        def done(timed_result):
+            callback(self._record(submitted, timed_result))
+        self._pool.apply_async(
+            _timed_check, [(password, hash_, deadline)], callback=done)
+
+    def check(self, password, hash_, timeout=None):
+        """
+        Like check_hash() but run in a worker process. Raise `Overloaded`
+        if the queue is full and `DeadlineExceeded` if the check did not
+        finish within `timeout` seconds. (If it was not started by then,
+        the worker skips it.)
+        """
+        results = []
+        finished = threading.Event()
+
+        def callback(result):
+            results.append(result)
+            finished.set()
+        deadline = None if timeout is None else time.time() + timeout
+        self.submit(password, hash_, callback, timeout)
+        # Event.wait() without a timeout can not be interrupted in Python 2.
+        while not finished.is_set():
+            wait = 1
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise DeadlineExceeded
+            finished.wait(wait)
+        if results[0] is None:
+            raise DeadlineExceeded
+        return results[0]
+
+    def check_many(self, pairs):
+        """
+        Check many (password, hash) pairs in parallel and return a list of
+        results in the same order. This is not limited by `max_queued`.
+        """
+        submitted = time.time()
+        with self._lock:
+            self._depth += len(pairs)
+            self._counters['submitted'] += len(pairs)
+        timed_results = self._pool.map(
+            _timed_check,
+            [(password, hash_, None) for password, hash_ in pairs])
+        return [self._record(submitted, timed_result)
+                for timed_result in timed_results]
+
+    def stats(self):
+        """
+        Return a dict of metrics: current queue `depth` (waiting or running
+        checks), counts of `submitted`, `completed`, `shed`, `expired` and
+        `errors` checks, and average or maximum times in seconds spent
+        waiting in the queue and hashing.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            depth = self._depth
+        completed = counters.pop('completed')
+        total_wait_time = counters.pop('wait_time')
+        total_hash_time = counters.pop('hash_time')
+        counters.update(
+            depth=depth,
+            max_queued=self.max_queued,
+            completed=completed,
+            average_wait_time=total_wait_time / completed if completed else 0,
+            average_hash_time=total_hash_time / completed if completed else 0,
+        )
+        return counters
+
+    def close(self):
+        """Wait for queued checks to finish and stop the workers."""
+        self._pool.close()
+        self._pool.join()
+
+
+def _call(args):
+    """Return (result, None) or (None, exception) for function(*args)."""
+    function, args = args[0], args[1:]
+    try:
+        return function(*args), None
+    except Exception as exc:
+        return None, exc
+
+
+class AsyncHasher(object):
+    """
+    Run make_hash() and check_hash() without blocking the calling thread,
+    for single-threaded servers such as `event_loop.EventLoop` or asyncio.
+    
+    Hashing happens in a pool of at most `max_concurrency` threads if the
+    current backend releases the GIL, or processes otherwise. The default
+    leaves one CPU for the rest of the server.
+    """
+    def __init__(self, max_concurrency=None):
+        self.max_concurrency = max_concurrency or max(
+            1, multiprocessing.cpu_count() - 1)
+        if BACKEND in GIL_RELEASING_BACKENDS:
+            self._pool = multiprocessing.pool.ThreadPool(self.max_concurrency)
+        else:
+            self._pool = multiprocessing.Pool(self.max_concurrency)
+
+    def _submit(self, callback, function, *args):
+        self._pool.apply_async(_call, [(function,) + args],
+                               callback=lambda result: callback(*result))
+
+    def make_hash(self, password, callback):
+        """
+        Start hashing a new password. `callback` is later called with the
+        new hash, from another thread. With an `EventLoop`, decorate the
+        callback with `loop.threadsafe_callback`.
+        """
+        def done(result, exc):
+            if exc is not None:
+                logging.error('make_hash() failed: %r', exc)
+            callback(result)
+        self._submit(done, make_hash, password)
+
+    def check_hash(self, password, hash_, callback):
+        """
+        Start checking a password. `callback` is later called with True
+        or False, from another thread. With an `EventLoop`, decorate the
+        callback with `loop.threadsafe_callback`. Errors, eg. for malformed
+        hashes, are logged and count as a failed check.
+        """
+        def done(result, exc):
+            if exc is not None:
+                logging.error('check_hash() failed: %r', exc)
+            callback(bool(result))
+        self._submit(done, check_hash, password, hash_)
+
+    def _future(self, loop, function, *args):
+        import asyncio  # Python 3.4+
+        loop = loop or asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def done(result, exc):
+            loop.call_soon_threadsafe(_resolve, future, result, exc)
+        self._submit(done, function, *args)
+        return future
+
+    def make_hash_future(self, password, loop=None):
+        """Return an asyncio Future for make_hash(password)."""
+        return self._future(loop, make_hash, password)
+
+    def check_hash_future(self, password, hash_, loop=None):
+        """Return an asyncio Future for check_hash(password, hash_)."""
+        return self._future(loop, check_hash, password, hash_)
+
+    def close(self):
+        """Wait for started hashes to finish and stop the pool."""
+        self._pool.close()
+        self._pool.join()
+
+
+def _resolve(future, result, exc):
+    if future.cancelled():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+def check_many(pairs, processes=None):
+    """
+    Check many (password, hash) pairs in parallel in a temporary pool of
+    `processes` worker processes and return a list of results in the same
+    order. Use a long-lived `VerificationPool` to avoid starting processes
+    every time.
+    """
+    pool = VerificationPool(processes)
+    try:
+        return pool.check_many(pairs)
+    finally:
+        pool.close()
+
+
+def benchmark(duration=2):
+    """
+    Print how many logins per second (`check_hash()` calls) a single core
+    can do with each available backend and the current parameters, and
+    with scrypt if available, then how PBKDF2 scales with a
+    `VerificationPool`.
+    """
+    global BACKEND
+    default_backend = BACKEND
+    hash_ = make_hash('something')
+    rates = {}
+    try:
+        for BACKEND in BACKENDS:
+            logins = 0
+            start = time.time()
+            while time.time() - start < duration:
+                check_hash('something', hash_)
+                logins += 1
+            rates[BACKEND] = logins / (time.time() - start)
+            print('%s: %.1f logins/s per core with %s and cost factor %i' % (
+                BACKEND, rates[BACKEND], HASH_FUNCTION, COST_FACTOR))
+    finally:
+        BACKEND = default_backend
+
+    if hasattr(hashlib, 'scrypt'):
+        parameters = ['SCRYPT', str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)]
+        print('scrypt: %.1f logins/s per core and %.1f MiB per concurrent '
+              'login with n=%i r=%i p=%i' % (
+                  1 / _time_check(parameters),
+                  scrypt_memory(SCRYPT_N, SCRYPT_R, SCRYPT_P) / 2 ** 20,
+                  SCRYPT_N, SCRYPT_R, SCRYPT_P))
+
+    for processes in sorted(set([1, multiprocessing.cpu_count()])):
+        pairs = [('something', hash_)] * int(
+            duration * processes * rates[BACKEND])
+        pool = VerificationPool(processes)
+        start = time.time()
+        pool.check_many(pairs)
+        print('%s: %.1f logins/s with a pool of %i processes' % (
+            BACKEND, len(pairs) / (time.time() - start), processes))
+        pool.close()
+
+
+def _time_pbkdf2(args):
+    """Return how long one PBKDF2 run takes with the given parameters."""
+    hash_function, cost_factor, backend = args
+    salt = b64encode(urandom(SALT_LENGTH))
+    start = time.time()
+    pbkdf2(b'something', salt, cost_factor, KEY_LENGTH, hash_function,
+           backend)
+    return time.time() - start
+
+
+def _percentile(sorted_values, percent):
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * percent / 100))]
+
+
+def calibrate(target=0.05, hash_functions=('sha1', 'sha256', 'sha512'),
+              samples=20):
+    """
+    For each hash function and backend, find the highest cost factor that
+    keeps the 99th percentile of the hashing time under `target` seconds.
+    Print the p50 and p99 latencies and the hashes per second on 1 to N
+    cores, and return the parameters to use with the current
+    `HASH_FUNCTION` and the fastest backend. (`HASH_FUNCTION` is measured
+    even if it is not in `hash_functions`.)
+    """
+    if HASH_FUNCTION not in hash_functions:
+        hash_functions = tuple(hash_functions) + (HASH_FUNCTION,)
+    chosen = None
+    cpu_count = multiprocessing.cpu_count()
+    for hash_function in hash_functions:
+        for backend in BACKENDS:
+            # The time is linear to the cost factor: measure a small one and
+            # extrapolate, then check and adjust with the real one.
+            small_cost = 1000
+            per_iteration = min(
+                _time_pbkdf2((hash_function, small_cost, backend))
+                for _ in range(3)) / small_cost
+            cost_factor = int(target / per_iteration)
+            for _ in range(3):
+                # Round down to two significant digits.
+                magnitude = 10 ** max(0, len(str(cost_factor)) - 2)
+                cost_factor = max(1, cost_factor // magnitude * magnitude)
+                latencies = sorted(
+                    _time_pbkdf2((hash_function, cost_factor, backend))
+                    for _ in range(samples))
+                p99 = _percentile(latencies, 99)
+                if p99 <= target:
+                    break
+                cost_factor = int(cost_factor * target / p99)
+            print('%s %s: cost factor %i, p50 %.1f ms, p99 %.1f ms' % (
+                hash_function, backend, cost_factor,
+                _percentile(latencies, 50) * 1000, p99 * 1000))
+            for cores in range(1, cpu_count + 1):
+                pool = multiprocessing.Pool(cores)
+                start = time.time()
+                pool.map(_time_pbkdf2,
+                         [(hash_function, cost_factor, backend)] * cores * 4)
+                print('    %i cores: %.1f hashes/s' % (
+                    cores, cores * 4 / (time.time() - start)))
+                pool.close()
+                pool.join()
+            if hash_function == HASH_FUNCTION and (
+                    chosen is None or cost_factor > chosen['cost_factor']):
+                chosen = dict(hash_function=hash_function, backend=backend,
+                              cost_factor=cost_factor)
+    return chosen
+
+
+def _time_check(parameters):
+    """
+    Return how long check_hash() takes for a hash with the given
+    parameters, as returned by `_parameters()`.
+    """
+    # A native string, like hashes read from a file. (Python 2's hashlib
+    # does not accept unicode hash function names.)
+    hash_ = str('$'.join(parameters + [
+        b64encode(urandom(SALT_LENGTH)).decode('ascii'),
+        b64encode(b'\0' * KEY_LENGTH).decode('ascii')]))
+    durations = []
+    for _ in range(3):
+        start = time.time()
+        check_hash('something', hash_)
+        durations.append(time.time() - start)
+    return min(durations)
+
+
+def _audit_label(hash_):
+    """
+    Return the parameters of a stored hash joined with '$', or None if it
+    is not a well-formed hash (eg. a disabled account or a header row).
+    """
+    fields = hash_.split('$')
+    if fields[0] == 'PBKDF2' and len(fields) == 5:
+        numbers = fields[2:3]
+    elif fields[0] == 'SCRYPT' and len(fields) == 6:
+        numbers = fields[1:4]
+    else:
+        return None
+    if not all(number.isdigit() for number in numbers):
+        return None
+    return '$'.join(_parameters(hash_))
+
+
+def audit(lines):
+    """
+    Print the distribution of parameters in an iterable of stored hashes
+    (eg. the lines of a database dump, where the hash is the last field)
+    and the expected CPU time per login with the current backend.
+    
+    Malformed hashes and those that can not be checked here (eg. with an
+    unknown hash function or scrypt on Python 2) are counted together on
+    an 'invalid/unknown' row.
+    """
+    parameters = Counter()
+    for line in lines:
+        fields = line.replace(':', ' ').split()
+        if fields:
+            parameters[_audit_label(fields[-1])] += 1
+    total = sum(parameters.values())
+    if not total:
+        print('No hash found.')
+        return
+    invalid = parameters.pop(None, 0)
+    rows = []
+    for label, count in parameters.most_common():
+        try:
+            login_time = _time_check(label.split('$'))
+        except Exception:
+            invalid += count
+        else:
+            rows.append((label, count, login_time))
+    current = '$'.join(_current_parameters())
+    print('%8s %7s  %-30s %s' % ('count', 'percent', 'parameters',
+                                'CPU ms per login'))
+    for label, count, login_time in rows:
+        print('%8i %6.1f%%  %-30s %.1f%s' % (
+            count, count * 100 / total, label, login_time * 1000,
+            '' if label == current else '  (needs update)'))
+    if invalid:
+        print('%8i %6.1f%%  %-30s -' % (
+            invalid, invalid * 100 / total, 'invalid/unknown'))
+    checked = total - invalid
+    if checked:
+        average_time = sum(login_time * count
+                           for _, count, login_time in rows) / checked
+        print('Average CPU time per login with the %s backend: %.1f ms' % (
+            BACKEND, average_time * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Tools for the password hashing parameters.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser(
+        'benchmark', help='Measure logins per second.')
+    calibrate_parser = subparsers.add_parser(
+        'calibrate', help='Find the best cost factor for this machine.')
+    calibrate_parser.add_argument(
+        '--target-ms', type=float, default=50,
+        help='Maximum time to hash a password. (default: %(default)s)')
+    calibrate_parser.add_argument(
+        '--write', nargs='?', const=CONFIG_FILE, metavar='CONFIG_FILE',
+        help='Write the chosen parameters to a config file read by '
+             'make_hash(). (default: %s)' % CONFIG_FILE)
+    audit_parser = subparsers.add_parser(
+        'audit', help='Report the parameters of existing hashes.')
+    audit_parser.add_argument(
+        'dump', type=argparse.FileType('r'),
+        help='A file with one hash at the end of each line, or - for stdin.')
+    args = parser.parse_args()
+
+    if args.command == 'audit':
+        audit(args.dump)
+    elif args.command == 'calibrate':
+        config = calibrate(args.target_ms / 1000)
+        print('Chosen: %s' % json.dumps(config, sort_keys=True))
+        if args.write and config is None:
+            parser.error('nothing calibrated, not writing %s' % args.write)
+        elif args.write:
+            with open(args.write, 'w') as file:
+                json.dump(config, file, indent=4, sort_keys=True)
+            print('Written to %s' % args.write)
+    else:
+        benchmark()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,45 @@
     Now use your templates as usual (with render_to_response, generic views or
     anything else that uses Django templates), and they will actually be
     rendered by Jinja2.
+
+    To keep compiled templates on disk across processes and deploys, set
+    a directory in settings.py:
+
+        JINJA2_BYTECODE_CACHE_DIR = '/var/cache/myproject/jinja2'
+
+    and fill it ahead of time (eg. when deploying) with a management
+    command. Create yourapp/management/commands/precompile_jinja2.py with:
+
+        from jinja2_for_django import PrecompileCommand as Command
+
+    then run `python manage.py precompile_jinja2`.
+
+    For big pages, views can send the output while it is rendered with
+    `stream_to_response` instead of `render_to_response`.
+
+    To see which templates are slow or recompiled often, set
+    `JINJA2_STATS = True`. Render counts and times, compiles and auto-reload
+    checks for each template are then kept in `jinja2_for_django.STATS` and
+    logged every `JINJA2_STATS_LOG_INTERVAL` seconds (300 by default, 0 to
+    disable).
+
+    By default Jinja2 checks the modification time of a template's source
+    file every time the template is used. In production, either disable
+    the checks or only do them every few seconds for each template, and
+    keep more compiled templates in memory:
+
+        JINJA2_AUTO_RELOAD = False  # or True with:
+        JINJA2_RELOAD_CHECK_INTERVAL = 10  # seconds
+        JINJA2_CACHE_SIZE = 1000  # templates, -1 for no limit
+
+    (Without JINJA2_CACHE_SIZE, Jinja2's own default is used.)
+    Templates can then be reloaded explicitly by touching a file:
+
+        JINJA2_RELOAD_FILE = '/srv/myproject/reload-templates'
+        JINJA2_RELOAD_FILE_CHECK_INTERVAL = 2  # seconds, the default
+
+    or with SIGHUP if `JINJA2_RELOAD_ON_SIGHUP = True`. (Only do that if
+    the server does not already use SIGHUP for itself.)
     
     See http://exyr.org/2010/Jinja-in-Django/
     
@@ -18,25 +57,273 @@
 
 """
 
+import os
+import sys
+import errno
+import time
+import bisect
+import logging
+import signal
+import threading
+from collections import defaultdict
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
 from django.template.loader import BaseLoader
 from django.template.loaders.app_directories import app_template_dirs
-from django.template import TemplateDoesNotExist
+from django.template import TemplateDoesNotExist, Context
+from django.core.management.base import BaseCommand
 from django.core import urlresolvers
 from django.conf import settings
 import jinja2
+from jinja2.utils import concat
+
+# Jinja2 2.11 changed handle_exception() to use sys.exc_info() itself.
+_JINJA2_VERSION = tuple(int(part) for part in
+                        jinja2.__version__.split('.')[:2])
+
+def _handle_exception(environment):
+    """
+    Re-raise the exception being handled with a traceback pointing at the
+    template source. Must be called in an `except` block.
+    """
+    if _JINJA2_VERSION >= (2, 11):
+        return environment.handle_exception()
+    return environment.handle_exception(sys.exc_info(), True)
+
+class ContextView(Mapping):
+    """
+    A read-only mapping of the variables in a Django Context, then in
+    Jinja2 globals. Names are looked up when a template uses them instead
+    of copying every dict of the context for every render.
+    """
+    def __init__(self, context, globals):
+        self.context = context
+        self.globals = globals
+
+    def __getitem__(self, key):
+        # Later dicts in the context take precedence.
+        for d in reversed(self.context.dicts):
+            if key in d:
+                return d[key]
+        return self.globals[key]
+
+    def __contains__(self, key):
+        return (any(key in d for d in self.context.dicts) or
+                key in self.globals)
+
+    def _keys(self):
+        keys = set(self.globals)
+        for d in self.context.dicts:
+            keys.update(d)
+        return keys
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def copy(self):
+        # Used by Jinja2 2.11+ to show template variables in tracebacks.
+        return dict((key, self[key]) for key in self._keys())
+
+class TemplateStats(object):
+    """
+    Counters for each template name: renders, a histogram of render times,
+    compiles and auto-reload (up-to-date) checks.
+    """
+    # Upper bounds of the histogram buckets, in milliseconds.
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))
+
+    def __init__(self, log_interval=300):
+        self.log_interval = log_interval
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.renders = defaultdict(int)
+            self.render_time = defaultdict(float)
+            self.histograms = defaultdict(lambda: [0] * len(self.BUCKETS))
+            self.compiles = defaultdict(int)
+            self.checks = defaultdict(int)
+            self._next_log = time.time() + self.log_interval
+
+    def record_render(self, name, seconds):
+        bucket = bisect.bisect_left(self.BUCKETS, seconds * 1000)
+        with self._lock:
+            self.renders[name] += 1
+            self.render_time[name] += seconds
+            self.histograms[name][bucket] += 1
+            log = self.log_interval and time.time() >= self._next_log
+            if log:
+                self._next_log = time.time() + self.log_interval
+        if log:
+            self.log()
+
+    def record_compile(self, name):
+        with self._lock:
+            self.compiles[name] += 1
+
+    def record_check(self, name):
+        with self._lock:
+            self.checks[name] += 1
+
+    def summary(self):
+        """Return a list of dicts, slowest templates (in total) first."""
+        with self._lock:
+            names = set(self.renders) | set(self.compiles) | set(self.checks)
+            result = [dict(
+                name=name,
+                renders=self.renders.get(name, 0),
+                total_ms=self.render_time.get(name, 0) * 1000,
+                histogram=list(zip(self.BUCKETS,
+                                   self.histograms.get(name, []))),
+                compiles=self.compiles.get(name, 0),
+                checks=self.checks.get(name, 0),
+            ) for name in names]
+        result.sort(key=lambda item: item['total_ms'], reverse=True)
+        return result
+
+    def log(self):
+        for item in self.summary():
+            self.logger.info(
+                '%s: %i renders, %.1f ms average, %i compiles, %i checks',
+                item['name'], item['renders'],
+                item['total_ms'] / (item['renders'] or 1),
+                item['compiles'], item['checks'])
+
+if getattr(settings, 'JINJA2_STATS', False):
+    STATS = TemplateStats(getattr(settings, 'JINJA2_STATS_LOG_INTERVAL', 300))
+else:
+    STATS = None
 
 class Template(jinja2.Template):
+    def _new_context(self, context):
+        return self.new_context(ContextView(context, self.globals),
+                                shared=True)
+
     def render(self, context):
-        # flatten the Django Context into a single dictionary.
-        context_dict = {}
-        for d in context.dicts:
-            context_dict.update(d)
-        return super(Template, self).render(context_dict)
+        # Same as jinja2.Template.render, but without flattening the
+        # Django Context into a single dictionary.
+        if STATS is not None:
+            start = time.time()
+        jinja_context = self._new_context(context)
+        try:
+            return concat(self.root_render_func(jinja_context))
+        except Exception:
+            return _handle_exception(self.environment)
+        finally:
+            if STATS is not None:
+                STATS.record_render(self.name, time.time() - start)
+
+    def generate(self, context):
+        """
+        Like render() but yield the output piece by piece, as it is
+        rendered. With JINJA2_STATS, the recorded time includes the time
+        spent by the consumer, eg. sending the response.
+        """
+        if STATS is not None:
+            start = time.time()
+        jinja_context = self._new_context(context)
+        try:
+            for event in self.root_render_func(jinja_context):
+                yield event
+        except Exception:
+            yield _handle_exception(self.environment)
+        finally:
+            if STATS is not None:
+                STATS.record_render(self.name, time.time() - start)
+
+    def stream(self, context, buffer_size=None):
+        """
+        Return an iterator of the output in chunks of `buffer_size` pieces
+        (JINJA2_STREAM_BUFFER_SIZE in settings by default), suitable for a
+        StreamingHttpResponse.
+        """
+        stream = jinja2.environment.TemplateStream(self.generate(context))
+        if buffer_size is None:
+            buffer_size = getattr(settings, 'JINJA2_STREAM_BUFFER_SIZE', 40)
+        if buffer_size > 1:
+            stream.enable_buffering(buffer_size)
+        return stream
+
+def _cache_options():
+    # Only override Jinja2's default cache size (400 since 2.8) if asked to.
+    if hasattr(settings, 'JINJA2_CACHE_SIZE'):
+        return dict(cache_size=settings.JINJA2_CACHE_SIZE)
+    return {}
+
+def _bytecode_cache():
+    directory = getattr(settings, 'JINJA2_BYTECODE_CACHE_DIR', None)
+    if directory:
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # Other processes starting at the same time may have created it.
+            if e.errno != errno.EEXIST:
+                raise
+        return jinja2.FileSystemBytecodeCache(directory)
+
+class Environment(jinja2.Environment):
+    def compile(self, source, name=None, *args, **kwargs):
+        # Only called when the bytecode cache (if any) misses.
+        if STATS is not None:
+            STATS.record_compile(name)
+        return super(Environment, self).compile(source, name, *args, **kwargs)
+
+class FileSystemLoader(jinja2.FileSystemLoader):
+    """
+    If `check_interval` is set, only check whether a template is up to date
+    once every `check_interval` seconds. The rest of the time, the cached
+    template is assumed to be up to date.
+    """
+    def __init__(self, searchpath, check_interval=0, **kwargs):
+        super(FileSystemLoader, self).__init__(searchpath, **kwargs)
+        self.check_interval = check_interval
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super(FileSystemLoader, self).get_source(
+            environment, template)
+        # uptodate is called by the environment for every cached template
+        # lookup when auto_reload is on.
+        if STATS is not None:
+            uptodate = _counting(uptodate, template)
+        if self.check_interval:
+            uptodate = _throttled(uptodate, self.check_interval)
+        return source, filename, uptodate
+
+def _counting(uptodate, template):
+    def counting_uptodate():
+        STATS.record_check(template)
+        return uptodate()
+    return counting_uptodate
+
+def _throttled(uptodate, interval):
+    last_check = [time.time()]  # The source was just loaded.
+    def throttled_uptodate():
+        now = time.time()
+        if now - last_check[0] < interval:
+            return True
+        last_check[0] = now
+        return uptodate()
+    return throttled_uptodate
 
 class Loader(BaseLoader):
     is_usable = True
 
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader(app_template_dirs))
+    env = Environment(
+        loader=FileSystemLoader(
+            app_template_dirs,
+            getattr(settings, 'JINJA2_RELOAD_CHECK_INTERVAL', 0)),
+        bytecode_cache=_bytecode_cache(),
+        auto_reload=getattr(settings, 'JINJA2_AUTO_RELOAD', True),
+        **_cache_options())
     env.template_class = Template
 
     # These are available to all templates.
@@ -45,9 +332,113 @@ class Loader(BaseLoader):
     #env.globals['STATIC_URL'] = settings.STATIC_URL
 
     def load_template(self, template_name, template_dirs=None):
+        reload_if_requested()
         try:
             template = self.env.get_template(template_name)
         except jinja2.TemplateNotFound:
             raise TemplateDoesNotExist(template_name)
         return template, template.filename
 
+def reload_templates():
+    """Forget all compiled templates kept in memory."""
+    if Loader.env.cache is not None:
+        Loader.env.cache.clear()
+
+_reload_requested = False
+_reload_file = getattr(settings, 'JINJA2_RELOAD_FILE', None)
+_reload_file_mtime = None
+_reload_check_interval = getattr(
+    settings, 'JINJA2_RELOAD_FILE_CHECK_INTERVAL', 2)
+_next_reload_check = 0
+
+def _get_mtime(filename):
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+if _reload_file:
+    _reload_file_mtime = _get_mtime(_reload_file)
+
+def reload_if_requested():
+    """
+    Call reload_templates() if SIGHUP was received or JINJA2_RELOAD_FILE
+    was touched since the last time.
+    """
+    global _reload_requested, _reload_file_mtime, _next_reload_check
+    if _reload_file:
+        now = time.time()
+        if now >= _next_reload_check:
+            _next_reload_check = now + _reload_check_interval
+            mtime = _get_mtime(_reload_file)
+            if mtime != _reload_file_mtime:
+                _reload_file_mtime = mtime
+                _reload_requested = True
+    if _reload_requested:
+        _reload_requested = False
+        reload_templates()
+
+def _request_reload(signum, frame):
+    # Only set a flag: the cache is not safe to modify from a signal handler.
+    global _reload_requested
+    _reload_requested = True
+
+if getattr(settings, 'JINJA2_RELOAD_ON_SIGHUP', False):
+    try:
+        signal.signal(signal.SIGHUP, _request_reload)
+    except ValueError:
+        # Not in the main thread: the server has to call reload_templates().
+        logging.getLogger(__name__).warning(
+            'Could not install the SIGHUP handler for template reloads.')
+
+def precompile_templates():
+    """
+    Compile every template in `app_template_dirs` so that the bytecode cache
+    is filled and new processes do not have to. Return a list of
+    (template name, error) for templates that are not valid Jinja2, such as
+    templates meant for Django.
+    """
+    errors = []
+    for name in Loader.env.list_templates():
+        try:
+            Loader.env.get_template(name)
+        except jinja2.TemplateSyntaxError as e:
+            errors.append((name, e))
+    return errors
+
+class PrecompileCommand(BaseCommand):
+    help = 'Compile all Jinja2 templates into the bytecode cache.'
+
+    def handle(self, *args, **options):
+        if Loader.env.bytecode_cache is None:
+            self.stderr.write('JINJA2_BYTECODE_CACHE_DIR is not set, '
+                              'compiled templates would not be kept.\n')
+            return
+        errors = precompile_templates()
+        for name, error in errors:
+            self.stderr.write('Skipped %s: %s\n' % (name, error))
+        self.stdout.write('Compiled %i templates.\n' % (
+            len(Loader.env.list_templates()) - len(errors)))
+
+def stream_to_response(template_name, dictionary=None, context_instance=None,
+                       buffer_size=None, **kwargs):
+    """
+    Like django.shortcuts.render_to_response, but return a Django 1.5+
+    StreamingHttpResponse that sends the page while it is rendered.
+    This lowers the time to first byte and memory use for big pages.
+    
+    Other keyword arguments are passed to the response. The template is
+    rendered lazily, so errors happen after the response headers are sent.
+    """
+    from django.http import StreamingHttpResponse
+    reload_if_requested()
+    try:
+        template = Loader.env.get_template(template_name)
+    except jinja2.TemplateNotFound:
+        raise TemplateDoesNotExist(template_name)
+    if context_instance is None:
+        context_instance = Context()
+    if dictionary:
+        context_instance.update(dictionary)
+    return StreamingHttpResponse(template.stream(context_instance, buffer_size),
+                                 **kwargs)
@@ -15,10 +15,19 @@
 """
 
 from __future__ import division
+import os
+import sys
 import string
 import itertools
-import random
-from collections import defaultdict
+import bisect
+import struct
+import argparse
+import multiprocessing
+from random import Random, SystemRandom
+import time
+from itertools import izip
+from array import array
+from collections import defaultdict, deque
 
 
 # This is a romanization of the opening of "Genji Monogatari"
@@ -104,6 +113,135 @@ def pairwise(iterable):
         a = b
 
 
+def windows(iterable, order):
+    """
+    Yield the states of a chain of the given order: the elements themselves
+    for order 1, tuples of `order` consecutive elements otherwise.
+    
+    >>> list(windows('abcd', 1))
+    ['a', 'b', 'c', 'd']
+    >>> list(windows('abcd', 3))
+    [('a', 'b', 'c'), ('b', 'c', 'd')]
+    """
+    if order == 1:
+        for element in iterable:
+            yield element
+        return
+    window = deque(maxlen=order)
+    for element in iterable:
+        window.append(element)
+        if len(window) == order:
+            yield tuple(window)
+
+
+def count_transitions(sample, order=1):
+    """
+    Return a dict of the number of occurences of each (state, next_state)
+    pair in `sample` for a chain of the given order.
+    
+    >>> sorted(count_transitions('abab').items())
+    [(('a', 'b'), 2), (('b', 'a'), 1)]
+    """
+    counts = defaultdict(int)
+    for pair in pairwise(windows(sample, order)):
+        counts[pair] += 1
+    return counts
+
+
+# magic, version, order, symbols kind ('b' or 'u'), C long size,
+# number of states, of transitions and of start states.
+MODEL_HEADER = struct.Struct('<4sHHcBIII')
+MODEL_MAGIC = 'MKCH'
+MODEL_VERSION = 1
+
+
+class URandom(object):
+    """
+    A source of random numbers that is suitable for passwords, unlike the
+    Mersenne Twister of the `random` module.
+    
+    Random bytes are read from `os.urandom()` in blocks of `block_size`
+    bytes, so most calls do not make a system call. Bounded integers are
+    made unbiased by rejection sampling.
+    
+    This has the `randrange()` and `choice()` methods used by `MarkovChain`,
+    with the same meaning as in the `random` module, and `randranges()`
+    for `MarkovChain.generate_many()`.
+    
+    The buffer is dropped in a `fork()`ed child process, which would
+    otherwise make the same passwords as its parent:
+    
+    >>> source = URandom()
+    >>> _ = source.randrange(2)  # Fill the buffer
+    >>> read_end, write_end = os.pipe()
+    >>> pid = os.fork()
+    >>> if pid == 0:
+    ...     _ = os.write(write_end, repr(source.randranges([1000] * 8)))
+    ...     os._exit(0)
+    >>> _ = os.waitpid(pid, 0)
+    >>> os.read(read_end, 1000) != repr(source.randranges([1000] * 8))
+    True
+    """
+    def __init__(self, block_size=4096):
+        self.block_size = block_size
+        self.syscalls = 0
+        self._next_word = iter(()).next
+        self._pid = None
+
+    def _refill(self):
+        words = array('I')
+        words.fromstring(os.urandom(self.block_size))
+        self._next_word = iter(words).next
+        self._pid = os.getpid()
+        self.syscalls += 1
+
+    def randrange(self, start, stop=None):
+        if stop is None:
+            start, stop = 0, start
+        n = stop - start
+        assert 0 < n <= 0x100000000
+        # The largest multiple of n that fits in 32 bits. Words above it
+        # would make smaller results a bit more likely.
+        limit = 0x100000000 - 0x100000000 % n
+        if os.getpid() != self._pid:
+            self._refill()
+        while 1:
+            try:
+                word = self._next_word()
+            except StopIteration:
+                self._refill()
+                continue
+            if word < limit:
+                return start + word % n
+
+    def choice(self, sequence):
+        return sequence[self.randrange(len(sequence))]
+
+    def randranges(self, stops):
+        """
+        Return a list of random numbers, like `[randrange(stop) for stop in
+        stops]` but without the overhead of a method call for each number.
+        """
+        if os.getpid() != self._pid:
+            self._refill()
+        results = []
+        append = results.append
+        next_word = self._next_word
+        for n in stops:
+            limit = 0x100000000 - 0x100000000 % n
+            while 1:
+                try:
+                    word = next_word()
+                except StopIteration:
+                    self._refill()
+                    next_word = self._next_word
+                    continue
+                if word < limit:
+                    append(word % n)
+                    break
+        return results
+
+
 class MarkovChain(object):
     """
     If a system transits from a state to another and the next state depends
@@ -116,48 +254,495 @@ class MarkovChain(object):
     
     The probabilities are built from the frequencies in the `sample` chain.
     Elements of the sample that are not a valid state are ignored.
+    
+    With `order` greater than 1, a state is the tuple of the last `order`
+    elements instead of the last element alone. Iterating the chain still
+    yields single elements.
+    
+    `random_source` is any object with `randrange()` and `choice()` methods
+    such as a `random.Random` instance. The default is a new `URandom`.
     """
-    def __init__(self, sample):
-        self.counts = counts = defaultdict(lambda: defaultdict(int))
-        for current, next in pairwise(sample):
-            counts[current][next] += 1
+    def __init__(self, sample, order=1, random_source=None):
+        self.order = order
+        self.random_source = random_source or URandom()
+        self._freeze(count_transitions(sample, order))
+
+    @classmethod
+    def from_counts(cls, counts, order=1, random_source=None):
+        """
+        Return a chain from a dict of transition counts as returned by
+        `count_transitions()` or `train()`.
+        """
+        chain = cls.__new__(cls)
+        chain.order = order
+        chain.random_source = random_source or URandom()
+        chain._freeze(counts)
+        return chain
+
+    def _freeze(self, counts):
+        """
+        Intern states to integer ids and store transitions in flat arrays:
+        the transitions from state `i` are at indexes `offsets[i]` to
+        `offsets[i + 1]` in `next_ids`. `cumulative[j]` is the sum of the
+        counts of all transitions before index `j`, so that the weight of
+        transition `j` is `cumulative[j + 1] - cumulative[j]`.
+        """
+        self._states = sorted(set(state for pair in counts for state in pair))
+        self._state_ids = state_ids = dict(
+            (state, id_) for id_, state in enumerate(self._states))
+        if self.order == 1:
+            self.symbols = self._states
+        else:
+            self.symbols = [state[-1] for state in self._states]
+
+        offsets = array('I')
+        next_ids = array('I')
+        cumulative = array('L', [0])
+        total = 0
+        for current_id, next_id, count in sorted(
+                (state_ids[current], state_ids[next], count)
+                for (current, next), count in counts.iteritems()):
+            while len(offsets) <= current_id:
+                offsets.append(len(next_ids))
+            next_ids.append(next_id)
+            total += count
+            cumulative.append(total)
+        while len(offsets) <= len(self._states):
+            offsets.append(len(next_ids))
+        self._offsets = offsets
+        self._next_ids = next_ids
+        self._cumulative = cumulative
+        # States that only appear at the very end of the sample have no
+        # transition. Start again from any other state when reaching them.
+        self._starts = array('I', (
+            id_ for id_ in xrange(len(self._states))
+            if offsets[id_] < offsets[id_ + 1]))
+        self._totals = None
+
+    @property
+    def states(self):
+        """The list of all states, indexed by state id."""
+        if self._states is None:
+            # Loaded from a model file, see `load()`.
+            blob = self._state_blob
+            if self.order == 1:
+                self._states = list(blob)
+            else:
+                self._states = [
+                    tuple(blob[i:i + self.order])
+                    for i in xrange(0, len(blob), self.order)]
+        return self._states
+
+    @property
+    def state_ids(self):
+        """A dict of state ids by state."""
+        if self._state_ids is None:
+            self._state_ids = dict(
+                (state, id_) for id_, state in enumerate(self.states))
+        return self._state_ids
+
+    def transition_counts(self):
+        """
+        Return a dict of the number of occurences of each (state, next_state)
+        pair in the training sample, as `count_transitions()` does.
+        """
+        states = self.states
+        offsets = self._offsets
+        next_ids = self._next_ids
+        cumulative = self._cumulative
+        counts = {}
+        for id_, state in enumerate(states):
+            for j in xrange(offsets[id_], offsets[id_ + 1]):
+                counts[state, states[next_ids[j]]] = (
+                    cumulative[j + 1] - cumulative[j])
+        return counts
+
+    def save(self, file):
+        """
+        Write the chain to `file`, opened in binary mode, so that `load()`
+        can read it back without training again.
+        
+        The format is a header (see `MODEL_HEADER`), followed by the raw
+        little-endian content of the offsets, next ids, start ids and
+        cumulative arrays, and the `order` symbols of each state. Symbols
+        must be single characters, of either byte or unicode strings.
         
-        self.totals = dict(
-            (current, sum(next_counts.itervalues()))
-            for current, next_counts in counts.iteritems()
-        )
+        Raise `ValueError` for a chain without any transition, which could
+        not generate anything.
+        """
+        if not self._starts:
+            raise ValueError('Cannot save a chain without transitions')
+        states = self.states
+        # An empty string of the same type as the symbols
+        empty = self.symbols[0][:0]
+        if self.order == 1:
+            blob = empty.join(states)
+        else:
+            blob = empty.join(empty.join(state) for state in states)
+        if isinstance(blob, unicode):
+            kind = 'u'
+            blob = blob.encode('utf-32-le')
+        else:
+            kind = 'b'
+        assert len(blob) == len(states) * self.order * (
+            4 if kind == 'u' else 1), 'Symbols must be single characters'
+        file.write(MODEL_HEADER.pack(
+            MODEL_MAGIC, MODEL_VERSION, self.order, kind,
+            self._cumulative.itemsize, len(states), len(self._next_ids),
+            len(self._starts)))
+        for array_ in [self._offsets, self._next_ids, self._starts,
+                       self._cumulative]:
+            if sys.byteorder != 'little':
+                array_ = array(array_.typecode, array_)
+                array_.byteswap()
+            file.write(array_.tostring())
+        file.write(blob)
+
+    @classmethod
+    def load(cls, file, random_source=None):
+        """
+        Return a chain read from `file`, opened in binary mode and written
+        by `save()`.
         
+        This only reads a few arrays with one `read()` call each, which is
+        much faster than training from a big sample. The list of states
+        is only built if `next()` or `states` are used.
+        """
+        (magic, version, order, kind, cumulative_itemsize, nb_states,
+         nb_transitions, nb_starts) = MODEL_HEADER.unpack(
+            file.read(MODEL_HEADER.size))
+        assert magic == MODEL_MAGIC, 'Not a Markov chain model file'
+        assert version == MODEL_VERSION, 'Unsupported version %i' % version
+        assert cumulative_itemsize == array('L').itemsize, (
+            'Model written on a platform with a different C long size')
+        chain = cls.__new__(cls)
+        chain.order = order
+        chain.random_source = random_source or URandom()
+        arrays = []
+        for typecode, length in [('I', nb_states + 1), ('I', nb_transitions),
+                                 ('I', nb_starts), ('L', nb_transitions + 1)]:
+            array_ = array(typecode)
+            array_.fromstring(file.read(length * array_.itemsize))
+            if sys.byteorder != 'little':
+                array_.byteswap()
+            arrays.append(array_)
+        chain._offsets, chain._next_ids, chain._starts, chain._cumulative = (
+            arrays)
+        blob = file.read(nb_states * order * (4 if kind == 'u' else 1))
+        if kind == 'u':
+            blob = blob.decode('utf-32-le')
+        chain._state_blob = blob
+        chain._states = None
+        chain._state_ids = None
+        chain._totals = None
+        # A (byte or unicode) string is indexable like a list of symbols.
+        chain.symbols = blob[order - 1::order]
+        return chain
+
+    def _next_id(self, state_id):
+        start = self._offsets[state_id]
+        end = self._offsets[state_id + 1]
+        if start == end:
+            return self.random_source.choice(self._starts)
+        cumulative = self._cumulative
+        # Like random.choice() but with a different weight for each element
+        rand = cumulative[start] + self.random_source.randrange(
+            0, cumulative[end] - cumulative[start])
+        # Transition j covers [cumulative[j], cumulative[j + 1])
+        j = bisect.bisect_right(cumulative, rand, start + 1, end + 1) - 1
+        return self._next_ids[j]
 
     def next(self, state):
         """
         Choose at random and return a next state from a current state,
         according to the probabilities for this chain
         """
-        nexts = self.counts[state].iteritems()
-        # Like random.choice() but with a different weight for each element
-        rand = random.randrange(0, self.totals[state])
-        # Using bisection here could be faster, but simplicity prevailed.
-        # (Also it’s not that slow with 26 states or so.)
-        for next_state, weight in nexts:
-            if rand < weight:
-                return next_state
-            rand -= weight
+        state_ids = self._state_ids
+        if state_ids is None:
+            state_ids = self.state_ids
+        return self._states[self._next_id(state_ids[state])]
     
+    def generate_many(self, n, length):
+        """
+        Return a list of `n` random strings of `length` elements each.
+        
+        All chains advance together one step at a time, drawing the random
+        numbers for a whole step with a single `randranges()` call when the
+        random source has it. With an order 4 chain and `URandom` this makes
+        about 30,000 passwords of 14 characters per second on CPython 2.7,
+        nearly twice as many as slicing the chain for each password. Run
+        `benchmark()` to measure on your machine.
+        """
+        offsets = self._offsets
+        next_ids = self._next_ids
+        cumulative = self._cumulative
+        starts = self._starts
+        symbols = self.symbols
+        bisect_right = bisect.bisect_right
+        randranges = getattr(self.random_source, 'randranges', None)
+        if randranges is None:
+            randrange = self.random_source.randrange
+            randranges = lambda stops: [randrange(stop) for stop in stops]
+        totals = self._totals
+        if totals is None:
+            # Dead ends draw one of the start states instead. Do not use
+            # `states`, which is slow to build for a loaded chain.
+            totals = self._totals = [
+                cumulative[offsets[id_ + 1]] - cumulative[offsets[id_]]
+                or len(starts)
+                for id_ in xrange(len(offsets) - 1)]
+        state_ids = [starts[i] for i in randranges([len(starts)] * n)]
+        columns = []
+        for _ in xrange(length):
+            next_state_ids = []
+            append = next_state_ids.append
+            draws = randranges([totals[state_id] for state_id in state_ids])
+            for state_id, rand in izip(state_ids, draws):
+                start = offsets[state_id]
+                end = offsets[state_id + 1]
+                if start == end:
+                    append(starts[rand])
+                    continue
+                rand += cumulative[start]
+                append(next_ids[
+                    bisect_right(cumulative, rand, start + 1, end + 1) - 1])
+            state_ids = next_state_ids
+            columns.append([symbols[state_id] for state_id in state_ids])
+        return [''.join(row) for row in izip(*columns)]
+
+    def write_many(self, n, length, file, batch_size=10000):
+        """
+        Write `n` random strings of `length` elements to `file`, one per
+        line, generating at most `batch_size` at a time to bound memory.
+        """
+        while n > 0:
+            batch = self.generate_many(min(n, batch_size), length)
+            file.write('\n'.join(batch) + '\n')
+            n -= len(batch)
+
     def __iter__(self):
         """
-        Return an infinite iterator of states.
+        Return an infinite iterator of elements.
         """
-        state = random.choice(self.counts.keys())
+        symbols = self.symbols
+        next_id = self._next_id
+        state_id = self.random_source.choice(self._starts)
         while True:
-            state = self.next(state)
-            yield state
+            state_id = next_id(state_id)
+            yield symbols[state_id]
+
+
+def letters(text):
+    """Keep only the ASCII letters of `text`, lower-cased."""
+    return (c for c in text.lower() if c in string.ascii_lowercase)
+
+
+def read_letters(filename, block_size=64 * 1024):
+    """
+    Yield the letters of a text file like `letters()` does, but read the
+    file by blocks of `block_size` bytes instead of all at once.
+    """
+    with open(filename) as file:
+        for block in iter(lambda: file.read(block_size), ''):
+            for letter in letters(block):
+                yield letter
+
+
+def count_file(args):
+    """
+    Return the transition counts for the letters of a file.
+    Takes a (filename, order) tuple to be usable with `Pool.imap()`.
+    """
+    filename, order = args
+    return dict(count_transitions(read_letters(filename), order))
+
+
+def train(filenames, order=1, processes=None, counts=None):
+    """
+    Count the transitions in the letters of many text files and return the
+    merged counts, to be used with `MarkovChain.from_counts()`.
+    
+    Files are counted in parallel by a pool of `processes` worker processes
+    (one per CPU by default) and streamed by blocks, so that memory only
+    grows with the number of distinct transitions, not with the size of the
+    corpus. To train incrementally, pass the `counts` of a previous training
+    (eg. from `MarkovChain.transition_counts()`) and only the new files.
+    """
+    counts = defaultdict(int, counts or {})
+    pool = multiprocessing.Pool(processes)
+    try:
+        for file_counts in pool.imap_unordered(
+                count_file, [(filename, order) for filename in filenames]):
+            for pair, count in file_counts.iteritems():
+                counts[pair] += count
+    finally:
+        pool.close()
+        pool.join()
+    return counts
+
+
+def _compare_next(chain, length):
+    """
+    Return how many characters per second `chain` generates with the linear
+    scan over the counts that `MarkovChain.next` originally did, with
+    `next()` and by iterating the chain.
+    """
+    counts = defaultdict(dict)
+    for (state, next_state), weight in chain.transition_counts().iteritems():
+        counts[state][next_state] = weight
+    totals = dict((state, sum(nexts.itervalues()))
+                  for state, nexts in counts.iteritems())
+    starts = [chain.states[id_] for id_ in chain._starts]
+    random_source = chain.random_source
+
+    def linear_next(state):
+        if state not in totals:
+            return random_source.choice(starts)
+        rand = random_source.randrange(0, totals[state])
+        for next_state, weight in counts[state].iteritems():
+            if rand < weight:
+                return next_state
+            rand -= weight
+
+    speeds = []
+    for next_ in [linear_next, chain.next]:
+        state = starts[0]
+        start = time.time()
+        for _ in xrange(length):
+            state = next_(state)
+        speeds.append(length / (time.time() - start))
+    start = time.time()
+    for _ in itertools.islice(chain, length):
+        pass
+    speeds.append(length / (time.time() - start))
+    return speeds
+
+
+def benchmark(length=100000, orders=(1, 2, 3, 4), passwords=20000,
+              alphabet_size=3000):
+    """
+    Print how many characters per second chains of various orders trained
+    on the `japanese` sample generate: with the linear scan over the counts
+    that `MarkovChain.next` originally did, with `next()` and by iterating
+    the chain. Then do the same with a random sample over an alphabet of
+    `alphabet_size` symbols, such as CJK characters.
+    
+    Bisection only pays off with many next states per state: with the 20
+    or so letters of the sample, the linear scan is actually a bit faster.
+    With thousands of symbols, bisection is several times faster.
+    
+    Then print how many 14 characters passwords per second are generated
+    one by one or with `generate_many()`.
+    Finally compare `URandom` with `random.SystemRandom`, which makes one
+    system call per random number.
+    """
+    for order in orders:
+        chain = MarkovChain(letters(japanese), order)
+        print ('order %i, %i states: linear scan %i, next() %i, '
+               'iteration %i characters/s' % (
+                   (order, len(chain.states)) +
+                   tuple(_compare_next(chain, length))))
+
+    sample_random = Random(0)
+    alphabet = [unichr(0x4e00 + i) for i in xrange(alphabet_size)]
+    large_chain = MarkovChain(
+        [sample_random.choice(alphabet) for _ in xrange(alphabet_size * 200)])
+    print ('%i symbols alphabet: linear scan %i, next() %i, '
+           'iteration %i characters/s' % (
+               (alphabet_size,) + tuple(_compare_next(large_chain, length))))
+
+    start = time.time()
+    for _ in xrange(passwords):
+        ''.join(itertools.islice(chain, 14))
+    print 'one by one: %i passwords/s' % (
+        passwords / (time.time() - start))
+    start = time.time()
+    chain.generate_many(passwords, 14)
+    print 'generate_many: %i passwords/s' % (
+        passwords / (time.time() - start))
+
+    random_source = URandom()
+    chain.random_source = random_source
+    start = time.time()
+    chain.generate_many(passwords, 14)
+    print 'URandom: %i passwords/s, %.3f syscalls per password' % (
+        passwords / (time.time() - start), random_source.syscalls / passwords)
+    chain.random_source = SystemRandom()
+    start = time.time()
+    chain.generate_many(passwords, 14)
+    # One system call per random number: one per character and one more
+    # for the initial state.
+    print 'SystemRandom: %i passwords/s, 15 syscalls per password' % (
+        passwords / (time.time() - start))
+
 
 def main():
-    chain = MarkovChain(
-        c for c in japanese.lower() if c in string.ascii_lowercase
-    )
-    print ''.join(itertools.islice(chain, 14))
+    parser = argparse.ArgumentParser(
+        description='Generate random pronounceable passwords.')
+    parser.add_argument(
+        '--model', metavar='MODEL',
+        help='Use a model file written by --train. The default is to train '
+             'on the sample Japanese text.')
+    parser.add_argument(
+        '--train', metavar='MODEL',
+        help='Train a chain on the letters of the CORPUS text files and '
+             'write it to a model file.')
+    parser.add_argument(
+        'corpus', nargs='*', metavar='CORPUS',
+        help='Text files to train on with --train.')
+    parser.add_argument(
+        '--update', action='store_true',
+        help='With --train, add the CORPUS files to an existing model '
+             'instead of starting from scratch.')
+    parser.add_argument(
+        '--processes', type=int,
+        help='Number of processes for --train. (default: one per CPU)')
+    parser.add_argument(
+        '--order', type=int, default=2,
+        help='Order of the trained chain. (default: %(default)s)')
+    parser.add_argument(
+        '--many', type=int, metavar='N',
+        help='Write N passwords, one per line.')
+    parser.add_argument(
+        '--benchmark', action='store_true',
+        help='Measure the speed of password generation.')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark()
+        return
+    if args.train:
+        if not args.corpus:
+            parser.error('--train needs at least one CORPUS file')
+        counts = None
+        order = args.order
+        if args.update:
+            with open(args.train, 'rb') as model_file:
+                chain = MarkovChain.load(model_file)
+            counts = chain.transition_counts()
+            order = chain.order
+        counts = train(args.corpus, order, args.processes, counts)
+        chain = MarkovChain.from_counts(counts, order)
+        if not chain._starts:
+            parser.error('no letters to train on in the CORPUS files')
+        # Replace the model atomically for processes that load it.
+        try:
+            with open(args.train + '.tmp', 'wb') as model_file:
+                chain.save(model_file)
+        except:
+            os.remove(args.train + '.tmp')
+            raise
+        os.rename(args.train + '.tmp', args.train)
+        return
+    if args.model:
+        with open(args.model, 'rb') as model_file:
+            chain = MarkovChain.load(model_file)
+    else:
+        chain = MarkovChain(letters(japanese), args.order)
+    if args.many:
+        chain.write_many(args.many, 14, sys.stdout)
+    else:
+        print ''.join(itertools.islice(chain, 14))
 
 if __name__ == '__main__':
     main()
-
@@ -16,7 +16,77 @@
 """
 
 import re
+import time
 import socket
+import threading
+from collections import OrderedDict
+
+
+class ReverseDNSCache(object):
+    """
+    Cache the results of socket.getfqdn(ip), which does a blocking DNS
+    query, in a least-recently-used dict of at most `max_size` entries.
+
+    Names are kept for `ttl` seconds, failed lookups (where getfqdn returns
+    the IP address itself) for `negative_ttl` seconds. When several threads
+    miss on the same IP address at the same time, only one of them does the
+    lookup and the others wait for its result.
+    """
+    def __init__(self, max_size=10000, ttl=3600, negative_ttl=300,
+                 resolve=socket.getfqdn):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.resolve = resolve
+        self.entries = OrderedDict()  # ip -> (host, expiry time)
+        self.in_flight = {}  # ip -> threading.Event
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0  # Misses that waited for another thread's lookup
+
+    def lookup(self, ip):
+        while 1:
+            with self.lock:
+                entry = self.entries.pop(ip, None)
+                if entry is not None and entry[1] > time.time():
+                    self.entries[ip] = entry  # Now the most recently used.
+                    self.hits += 1
+                    return entry[0]
+                event = self.in_flight.get(ip)
+                if event is None:
+                    event = self.in_flight[ip] = threading.Event()
+                    self.misses += 1
+                    break
+                self.waits += 1
+            event.wait()
+            # Use the other thread's result directly: it is not a hit.
+            host = getattr(event, 'host', None)
+            if host is not None:
+                return host
+            # The lookup failed, try again.
+
+        try:
+            host = self.resolve(ip)
+            ttl = self.negative_ttl if host == ip else self.ttl
+            with self.lock:
+                self.entries[ip] = (host, time.time() + ttl)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+            event.host = host
+        finally:
+            with self.lock:
+                del self.in_flight[ip]
+            event.set()
+        return host
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, waits=self.waits,
+                        size=len(self.entries))
+
+
+reverse_dns = ReverseDNSCache()
 
 
 def application(environ, start_response):
@@ -25,7 +95,7 @@ def application(environ, start_response):
     if re.match('::ffff:\d+\.\d+\.\d+.\d+', ip):
         # IPv4 in v6, eg ::ffff:127.0.0.1
         ip = ip[len('::ffff:'):]
-    host = socket.getfqdn(ip)
+    host = reverse_dns.lookup(ip)
     start_response('200 OK', [('Content-Type', 'text/html')])
     return ['Connecting from <strong>%(ip)s</strong> @ '
             '<strong>%(host)s</strong>.' % locals()]
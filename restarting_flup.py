@@ -7,24 +7,426 @@ date changes. Assuming you have something[2] that restarts FastCGI processes
 as needed (which you should anyway), this effectively allows you to reload
 the application by just `touch`ing one file.
 
+On Linux, the file is watched with inotify so that changes are seen right
+away at no cost while idle. Pass `watch=[directory, ...]` to RestartingServer
+to also restart when a .py file in these directories changes. Elsewhere,
+the modification date of the .fcgi file is checked on every iteration of
+flup’s main loop (about once per second).
+
+Alternatively, `Master` keeps the listening socket in a master process and
+reloads by starting (and warming up) new worker processes before stopping
+the old ones, so that no request fails or waits for the application to be
+imported. SIGHUP to the master process also reloads.
+
 [1] http://flask.pocoo.org/docs/deploying/fastcgi/
 [2] Something like Circus, Supervisord, or Lighttpd with `bin-path` configured.
 
 """
 
+import os
+import sys
+import errno
+import fcntl
+import select
+import signal
+import struct
+import threading
+import time
+import ctypes
+import ctypes.util
+import traceback
 from os.path import getmtime
+from wsgiref.util import setup_testing_defaults
 from flup.server.fcgi import WSGIServer
+from flup.server.fcgi_base import BaseFCGIServer
+from flup.server.threadedserver import ThreadedServer
 
 
 START_TIME = getmtime(__file__)
 
+# From <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4  # `touch` only changes the modification date.
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def inotify_watch(paths):
+    """
+    Return a file descriptor for inotify events on these directories,
+    or None if inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        inotify_init = libc.inotify_init
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    fd = inotify_init()
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    for path in paths:
+        if inotify_add_watch(fd, path.encode('utf8'), mask) < 0:
+            os.close(fd)
+            return None
+    return fd
+
+
+def read_events(fd):
+    """
+    Wait for inotify events if there are none yet, and return the file
+    names of those available.
+    """
+    data = os.read(fd, 4096)
+    names = []
+    pos = 0
+    while pos < len(data):
+        _wd, _mask, _cookie, length = IN_EVENT_HEADER.unpack_from(data, pos)
+        pos += IN_EVENT_HEADER.size
+        names.append(data[pos:pos + length].rstrip(b'\0').decode('utf8'))
+        pos += length
+    return names
+
+
+def walk_directories(watch):
+    """Return these directories and their subdirectories."""
+    # inotify is not recursive.
+    return [directory for top in watch
+            for directory, _dirs, _files in os.walk(top)]
+
+
+def triggers_reload(names, watching_packages):
+    """
+    Whether these inotify file names include the .fcgi file, or a .py file
+    when watching application packages.
+    """
+    fcgi_name = os.path.basename(__file__)
+    return any(name == fcgi_name or
+               (watching_packages and name.endswith('.py'))
+               for name in names)
+
 
 class RestartingServer(WSGIServer):
+    def __init__(self, application, watch=(), **kwargs):
+        WSGIServer.__init__(self, application, **kwargs)
+        self._watched_dirs = walk_directories(watch)
+        self._inotify_fd = None
+
+    def _installSignalHandlers(self):
+        WSGIServer._installSignalHandlers(self)
+        # Once flup handles SIGINT, the watcher can use it to stop the
+        # main loop.
+        directories = [os.path.dirname(os.path.abspath(__file__))]
+        self._inotify_fd = inotify_watch(directories + self._watched_dirs)
+        if self._inotify_fd is not None:
+            thread = threading.Thread(target=self._watch)
+            thread.daemon = True
+            thread.start()
+            # In case it changed before the watch started.
+            if getmtime(__file__) != START_TIME:
+                self._keepGoing = False
+
+    def _watch(self):
+        # Editors often write a new file and rename it, so watch directories
+        # rather than files.
+        while not triggers_reload(read_events(self._inotify_fd),
+                                  self._watched_dirs):
+            pass
+        os.kill(os.getpid(), signal.SIGINT)
+
     def _mainloopPeriodic(self):
         WSGIServer._mainloopPeriodic(self)
-        if getmtime(__file__) != START_TIME:
+        if self._inotify_fd is None and getmtime(__file__) != START_TIME:
             self._keepGoing = False
 
 
-from YOUR_APPLICATION import app
-RestartingServer(app).run()
+class Master(object):
+    """
+    Hold the FastCGI listening socket and fork `processes` workers that
+    each run a threaded flup server on it.
+
+    On SIGHUP or when a watched file changes, fork a new generation of
+    workers. Each of them calls `load_app()` (so that the application is
+    imported fresh) and requests each of `warm_up_urls` before accepting
+    connections. Only once they are all ready, the old workers are sent
+    SIGTERM: they stop accepting and finish their current requests. If the
+    new generation fails to start, the old one keeps running.
+
+    Workers that die are replaced. If a replacement fails to start, it is
+    retried after a delay that doubles with each consecutive failure, up
+    to `max_retry_delay` seconds. SIGTERM or SIGINT stop everything.
+    """
+    def __init__(self, load_app, processes=4, warm_up_urls=(), watch=(),
+                 max_retry_delay=60, **server_kwargs):
+        self.load_app = load_app
+        self.processes = processes
+        self.warm_up_urls = warm_up_urls
+        self.watched_dirs = walk_directories(watch)
+        self.max_retry_delay = max_retry_delay
+        self.server_kwargs = server_kwargs
+        self.workers = {}  # pid -> [generation, ready]
+        self.ready_pipes = {}  # fd -> pid
+        self.generation = 0
+        self.current = None  # The generation serving requests
+        self.pending = None  # The generation starting up, if any
+        self._reload = False
+        self._stop = False
+        self._failures = 0  # Consecutive replacements that failed to start
+        self._retries = []  # (time, generation) of replacements to spawn
+
+    def run(self):
+        base = BaseFCGIServer(
+            None, bindAddress=self.server_kwargs.get('bindAddress'),
+            umask=self.server_kwargs.get('umask'),
+            forceCGI=self.server_kwargs.get('forceCGI', False))
+        self.sock = base._setupSocket()
+        # With a blocking socket, workers that lose the race for a new
+        # connection would block in accept() instead of noticing SIGTERM.
+        self.sock.setblocking(False)
+
+        self.wake_up_r, self.wake_up_w = os.pipe()
+        for fd in (self.wake_up_r, self.wake_up_w):
+            set_nonblocking(fd)
+        signal.set_wakeup_fd(self.wake_up_w)
+        signal.signal(signal.SIGHUP, self._request_reload)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        # A Python handler is needed for SIGCHLD to write to the wake-up fd.
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        directory = os.path.dirname(os.path.abspath(__file__))
+        self.inotify_fd = inotify_watch([directory] + self.watched_dirs)
+        self.mtime = getmtime(__file__)
+
+        self._start_generation()
+        while not self._stop:
+            self._wait()
+            self._reap()
+            self._retry()
+            if self._reload:
+                self._reload = False
+                self._start_generation()
+
+        self._kill_workers(lambda generation: True)
+        self._reap(block=True)
+        base._cleanupSocket(self.sock)
+
+    def _wait(self):
+        fds = [self.wake_up_r] + list(self.ready_pipes)
+        if self.inotify_fd is not None:
+            fds.append(self.inotify_fd)
+            timeout = None
+        else:
+            timeout = 1
+        if self._retries:
+            delay = max(0, min(self._retries)[0] - time.time())
+            timeout = delay if timeout is None else min(timeout, delay)
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        for fd in readable:
+            if fd == self.wake_up_r:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            elif fd == self.inotify_fd:
+                if triggers_reload(read_events(fd), self.watched_dirs):
+                    self._reload = True
+                    # Saving or touching a file often makes several events.
+                    time.sleep(0.1)
+                    while select.select([fd], [], [], 0)[0]:
+                        read_events(fd)
+            else:
+                self._worker_ready(fd)
+        if self.inotify_fd is None:
+            mtime = getmtime(__file__)
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self._reload = True
+
+    def _start_generation(self):
+        if self.pending is not None:
+            # A reload is already in progress. Start over with newer code.
+            pending = self.pending
+            self._kill_workers(lambda gen: gen == pending)
+        self.generation += 1
+        self.pending = self.generation
+        for _ in range(self.processes):
+            self._spawn(self.pending)
+
+    def _spawn(self, generation):
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            self._worker(ready_w)  # Does not return.
+        os.close(ready_w)
+        self.workers[pid] = [generation, False]
+        self.ready_pipes[ready_r] = pid
+
+    def _worker_ready(self, fd):
+        pid = self.ready_pipes.pop(fd)
+        ready = os.read(fd, 1)
+        os.close(fd)
+        if not ready or pid not in self.workers:
+            return  # It died before being ready, see _reap().
+        worker = self.workers[pid]
+        worker[1] = True
+        generation = worker[0]
+        if generation == self.current:
+            self._failures = 0
+        workers = [ready for gen, ready in self.workers.values()
+                   if gen == generation]
+        if (generation == self.pending and len(workers) == self.processes
+                and all(workers)):
+            self.current, self.pending = generation, None
+            self._kill_workers(lambda gen: gen != generation)
+            log('Generation %i is serving requests.' % generation)
+
+    def _reap(self, block=False):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                return
+            generation, ready = self.workers.pop(pid)
+            for fd, fd_pid in list(self.ready_pipes.items()):
+                if fd_pid == pid:
+                    del self.ready_pipes[fd]
+                    os.close(fd)
+            if self._stop:
+                continue
+            if generation == self.pending and not ready:
+                log('A worker of generation %i failed to start.' % generation)
+                self._kill_workers(lambda gen: gen == generation)
+                self.pending = None
+                if self.current is None:
+                    self._stop = True
+            elif ready and generation in (self.current, self.pending):
+                self._spawn(generation)
+            elif generation == self.current:
+                delay = min(self.max_retry_delay, 2 ** self._failures)
+                self._failures += 1
+                log('A replacement worker failed to start, retrying in %i s.'
+                    % delay)
+                self._retries.append((time.time() + delay, generation))
+
+    def _retry(self):
+        """Spawn the replacement workers that are due."""
+        now = time.time()
+        retries = self._retries
+        self._retries = []
+        for when, generation in retries:
+            if generation != self.current:
+                continue  # Replaced by a newer generation in the meantime.
+            if when <= now:
+                self._spawn(generation)
+            else:
+                self._retries.append((when, generation))
+
+    def _kill_workers(self, condition):
+        """Send SIGTERM to workers whose generation matches `condition`."""
+        for pid, (generation, _ready) in self.workers.items():
+            if condition(generation):
+                self._kill(pid)
+
+    def _kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _request_reload(self, signum, frame):
+        self._reload = True
+
+    def _request_stop(self, signum, frame):
+        self._stop = True
+
+    def _worker(self, ready_fd):
+        status = 1
+        try:
+            # Until flup installs its own handlers, SIGTERM simply kills
+            # a worker that is still starting.
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                           signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            os.close(self.wake_up_r)
+            os.close(self.wake_up_w)
+            for fd in self.ready_pipes:
+                os.close(fd)
+            if self.inotify_fd is not None:
+                os.close(self.inotify_fd)
+
+            app = self.load_app()
+            for url in self.warm_up_urls:
+                warm_up(app, url)
+            kwargs = dict(self.server_kwargs, multiprocess=True)
+            server = WSGIServer(app, **kwargs)
+            # Normally done by WSGIServer.run(), which also sets up a socket.
+            addrs = os.environ.get('FCGI_WEB_SERVER_ADDRS')
+            server._web_server_addrs = addrs and [
+                addr.strip() for addr in addrs.split(',')]
+
+            os.write(ready_fd, b'1')
+            os.close(ready_fd)
+            # Returns on SIGTERM, after which we finish current requests.
+            ThreadedServer.run(server, self.sock)
+            # flup's ThreadPool.shutdown() drops connections that were
+            # accepted but not picked up by a thread yet.
+            while server._threadPool._workQueue:
+                time.sleep(0.01)
+            server.shutdown()
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def warm_up(app, url):
+    """Make a GET request to the WSGI app and discard the response."""
+    path, _, query = url.partition('?')
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query}
+    setup_testing_defaults(environ)
+    response = app(environ, lambda status, headers, exc_info=None: None)
+    try:
+        for _chunk in response:
+            pass
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+
+
+def log(message):
+    sys.stderr.write('restarting_flup[%i]: %s\n' % (os.getpid(), message))
+
+
+def load_app():
+    from YOUR_APPLICATION import app
+    return app
+
+
+# Either exit on changes and let something else start a new process:
+#RestartingServer(load_app()).run()
+# or keep a master process with preforked workers, with no downtime:
+Master(load_app, processes=4, warm_up_urls=['/']).run()
@@ -1,6 +1,24 @@
 """A stupidly simple, unsafe, and inefficient template engine."""
 
+import os
 import re
+import sys
+import time
+import types
+import string
+import keyword
+import itertools
+import threading
+from collections import OrderedDict
+
+try:
+    import builtins
+except ImportError:  # Python 2
+    import __builtin__ as builtins
+
+
+FOR_RE = re.compile(r'for\s+(\w+)\s+in\s+(.+)')
+IF_RE = re.compile(r'if\s+(.+)')
 
 
 def parse(source):
@@ -14,7 +32,7 @@ def parse(source):
         code, _, source = source.partition('%}')
         code = code.strip()
 
-        match = re.match('for\s+(\w+)\s+in\s+(.+)', code)
+        match = FOR_RE.match(code)
         if match:
             item_name, expr = match.groups()
             child_nodes = []
@@ -23,7 +41,7 @@ def parse(source):
             nodes = child_nodes
             continue
 
-        match = re.match('if\s+(.+)', code)
+        match = IF_RE.match(code)
         if match:
             expr, = match.groups()
             child_nodes = []
@@ -37,25 +55,458 @@ def parse(source):
 
 
 def render(nodes, context, write):
+    # Work on a copy so that the caller's dict is left alone. Loops then
+    # bind their variable in this one dict and restore it afterwards,
+    # instead of copying the whole context for every item.
+    _render(nodes, dict(context), write)
+
+
+_MISSING = object()
+
+
+if hasattr(str, 'format_map'):
+    def _format(text, context):
+        return text.format_map(context)
+else:  # Python 2
+    _FORMATTER = string.Formatter()
+
+    def _format(text, context):
+        # Unlike text.format(**context), only look up the names used.
+        return _FORMATTER.vformat(text, (), context)
+
+
+def _render(nodes, context, write):
+    for node_type, value in nodes:
+        if node_type == 'text':
+            write(_format(value, context))
+        elif node_type == 'for':
+            item_name, expr, child_nodes = value
+            saved = context.get(item_name, _MISSING)
+            try:
+                for value in eval(expr, context, context):
+                    context[item_name] = value
+                    _render(child_nodes, context, write)
+            finally:
+                if saved is _MISSING:
+                    context.pop(item_name, None)
+                else:
+                    context[item_name] = saved
+        elif node_type == 'if':
+            expr, child_nodes = value
+            if eval(expr, context, context):
+                _render(child_nodes, context, write)
+        else:
+            assert 0, node_type
+
+
+def _iter_render(nodes, context):
+    """Like `_render()`, but yield fragments instead of writing them."""
     for node_type, value in nodes:
         if node_type == 'text':
-            write(value.format(**context))
+            yield _format(value, context)
         elif node_type == 'for':
             item_name, expr, child_nodes = value
-            for value in eval(expr, context, context):
-                inner_context = context.copy()
-                inner_context[item_name] = value
-                render(child_nodes, inner_context, write)
+            saved = context.get(item_name, _MISSING)
+            try:
+                for value in eval(expr, context, context):
+                    context[item_name] = value
+                    for fragment in _iter_render(child_nodes, context):
+                        yield fragment
+            finally:
+                if saved is _MISSING:
+                    context.pop(item_name, None)
+                else:
+                    context[item_name] = saved
         elif node_type == 'if':
             expr, child_nodes = value
             if eval(expr, context, context):
-                render(child_nodes, context, write)
+                for fragment in _iter_render(child_nodes, context):
+                    yield fragment
         else:
             assert 0, node_type
 
 
+def render_iter(nodes, context, buffer_size=8192):
+    """
+    Like `render()`, but return an iterator of chunks of output instead of
+    calling `write` for every fragment. See `iter_chunks()`.
+    """
+    return iter_chunks(_iter_render(nodes, dict(context)), buffer_size)
+
+
+def iter_chunks(fragments, buffer_size=8192):
+    """
+    Join an iterable of strings into fewer, bigger ones of `buffer_size`
+    characters, except the last one which may be shorter. Big fragments
+    are split, so chunks are never bigger than that, while the number of
+    writes (eg. to a socket by a WSGI server) is much lower.
+    """
+    buffer = []
+    size = 0
+    for fragment in fragments:
+        buffer.append(fragment)
+        size += len(fragment)
+        if size >= buffer_size:
+            data = ''.join(buffer)
+            end = len(data) - len(data) % buffer_size
+            for start in range(0, end, buffer_size):
+                yield data[start:start + buffer_size]
+            rest = data[end:]
+            buffer = [rest] if rest else []
+            size = len(rest)
+    if buffer:
+        yield ''.join(buffer)
+
+
+# Names used by the generated code. Template variables must not start
+# with this prefix.
+_PREFIX = '__st_'
+_NAME_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+
+
+def _is_plain_name(name):
+    """Whether `name` can be used as a Python variable in generated code."""
+    return bool(_NAME_RE.match(name) and not keyword.iskeyword(name) and
+                name not in ('None', 'True', 'False') and
+                not name.startswith(_PREFIX))
+
+
+class _NotCompilable(Exception):
+    pass
+
+
+def _compile_format(text, names, loop_names):
+    """
+    Return a format string equivalent to `text` where each field refers
+    to a positional argument instead of a name. The Python expressions for
+    the arguments are appended to `names`, in order: the variable itself
+    for names in `loop_names`, or a lookup in the context. Like with
+    `render()`, other names are not looked up in builtins and a missing
+    name raises `KeyError`.
+    """
+    parts = []
+    for literal, field_name, format_spec, conversion in (
+            string.Formatter().parse(text)):
+        parts.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field_name is None:
+            continue
+        root = re.match(r'[^.[]*', field_name).group()
+        assert root and not root.isdigit(), 'Positional field ' + field_name
+        if root in loop_names:
+            expression = root
+        else:
+            expression = '%scontext[%r]' % (_PREFIX, root)
+        if expression not in names:
+            names.append(expression)
+        parts.append('{%i%s' % (names.index(expression),
+                                field_name[len(root):]))
+        if conversion:
+            parts.append('!' + conversion)
+        if format_spec:
+            # The format spec may contain nested fields.
+            parts.append(':' + _compile_format(format_spec, names,
+                                                 loop_names))
+        parts.append('}')
+    return ''.join(parts)
+
+
+def _compile_nodes(nodes, lines, indent, counter, generator,
+                   loop_names=frozenset()):
+    """
+    Append to `lines` the Python source for `nodes`, that calls the write
+    function with each fragment or, if `generator` is true, yields them.
+    `loop_names` are the variables of the enclosing loops.
+    Raise `_NotCompilable` for loop variables that are not valid Python
+    variables.
+    """
+    prefix = '    ' * indent
+    output = 'yield %s' if generator else _PREFIX + 'write(%s)'
+    start = len(lines)
+    for node_type, value in nodes:
+        if node_type == 'text':
+            names = []
+            format_string = _compile_format(value, names, loop_names)
+            if names:
+                lines.append(prefix + output % '%r.format(%s)' % (
+                    format_string, ', '.join(names)))
+            elif value:
+                # Static text: format once now.
+                lines.append(prefix + output % repr(value.format()))
+        elif node_type == 'for':
+            item_name, expr, child_nodes = value
+            if not _is_plain_name(item_name):
+                raise _NotCompilable(item_name)
+            # The loop body is a nested function so that the loop variable
+            # is local to it and only shadows other names inside the loop,
+            # like with `render()`'s inner context.
+            function_name = '%sfor_%i' % (_PREFIX, next(counter))
+            lines.append(prefix + 'def %s(%s):' % (function_name, item_name))
+            if generator:
+                # Make it a generator even if it yields nothing.
+                lines.append(prefix + '    if 0: yield')
+            _compile_nodes(child_nodes, lines, indent + 1, counter, generator,
+                           loop_names | frozenset([item_name]))
+            lines.append(prefix + 'for %sitem in (%s):' % (_PREFIX, expr))
+            if generator:
+                lines.append(prefix + '    for %sfragment in %s(%sitem):'
+                             % (_PREFIX, function_name, _PREFIX))
+                lines.append(prefix + '        yield %sfragment' % _PREFIX)
+            else:
+                lines.append(prefix + '    %s(%sitem)'
+                             % (function_name, _PREFIX))
+        elif node_type == 'if':
+            expr, child_nodes = value
+            lines.append(prefix + 'if (%s):' % expr)
+            _compile_nodes(child_nodes, lines, indent + 1, counter, generator,
+                           loop_names)
+        else:
+            assert 0, node_type
+    if len(lines) == start:
+        lines.append(prefix + 'pass')
+
+
+def _compile_code(nodes, generator):
+    if generator:
+        lines = ['def _render(%scontext):' % _PREFIX, '    if 0: yield']
+    else:
+        lines = ['def _render(%swrite, %scontext):' % (_PREFIX, _PREFIX)]
+    _compile_nodes(nodes, lines, 1, itertools.count(), generator)
+    namespace = {}
+    exec(compile('\n'.join(lines), '<template>', 'exec'), namespace)
+    return namespace['_render'].__code__
+
+
+class Template(object):
+    """
+    Parsed template nodes compiled to Python code once. Call it with the
+    same `context` and `write` parameters as `render()` for the same
+    output, only faster.
+    
+    The template becomes a single Python function where expressions are
+    plain Python code. `context` is used as the globals of that function,
+    so that names in expressions are looked up directly in it (and then in
+    builtins, like with `eval()`). Format fields are looked up in the
+    context only, or are loop variables. Templates with loop variables
+    that cannot be Python variables, like `class`, are not compiled and
+    use `render()` instead.
+    """
+    def __init__(self, nodes):
+        self._nodes = nodes
+        try:
+            self._code = _compile_code(nodes, generator=False)
+        except _NotCompilable:
+            self._code = None
+        self._generator_code = None
+
+    def __call__(self, context, write):
+        if self._code is None:
+            return render(self._nodes, context, write)
+        # Like eval(), make builtins available.
+        context.setdefault('__builtins__', builtins)
+        types.FunctionType(self._code, context)(write, context)
+
+    def render_iter(self, context, buffer_size=8192):
+        """
+        Like `render_iter()`: return an iterator of chunks of output.
+        The first chunk is available as soon as `buffer_size` characters
+        are rendered.
+        """
+        if self._code is None:
+            return render_iter(self._nodes, context, buffer_size)
+        if self._generator_code is None:
+            self._generator_code = _compile_code(self._nodes, generator=True)
+        context.setdefault('__builtins__', builtins)
+        return iter_chunks(
+            types.FunctionType(self._generator_code, context)(context),
+            buffer_size)
+
+
+def compile_template(nodes):
+    """Return a `Template` for parsed nodes."""
+    return Template(nodes)
+
+
+class Loader(object):
+    """
+    Load templates from files in `directory` and keep them compiled.
+    
+    A cached template is reloaded when the modification time or size of
+    its file changes, but files are checked at most once every
+    `check_interval` seconds. When the total size of cached templates
+    (approximated by the size of their source) goes over `max_size` bytes,
+    the least recently used templates are dropped.
+    """
+    def __init__(self, directory, check_interval=2, max_size=16 * 1024 ** 2):
+        self.directory = os.path.abspath(directory)
+        self.check_interval = check_interval
+        self.max_size = max_size
+        # name -> (template, stat key, last check time, size) with the most
+        # recently used last.
+        self._cache = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}  # name -> threading.Event
+
+    def _path(self, name):
+        path = os.path.normpath(os.path.join(self.directory, name))
+        if not path.startswith(self.directory + os.sep):
+            raise ValueError('Template outside of the directory: %r' % name)
+        return path
+
+    def _add(self, name, entry):
+        self._cache[name] = entry
+        self._size += entry[3]
+
+    def get_template(self, name):
+        """
+        Return a compiled `Template` for the file `name`, relative to the
+        directory.
+        """
+        path = self._path(name)
+        while 1:
+            with self._lock:
+                now = time.time()
+                entry = self._cache.pop(name, None)
+                if entry is not None:
+                    self._cache[name] = entry  # Now the most recently used.
+                    if now - entry[2] < self.check_interval:
+                        return entry[0]
+                event = self._in_flight.get(name)
+                if event is None:
+                    event = self._in_flight[name] = threading.Event()
+                    break
+            # Another thread is checking or loading this file: use its
+            # result instead of loading it again.
+            event.wait()
+            template = getattr(event, 'template', None)
+            if template is not None:
+                return template
+            # The load failed, try again.
+
+        # Outside of the lock so that other templates can be used meanwhile.
+        try:
+            key = _stat_key(path)
+            if entry is not None and entry[1] == key:
+                template, size = entry[0], entry[3]
+            else:
+                with open(path) as file:
+                    source = file.read()
+                template = Template(parse(source))
+                size = len(source)
+            with self._lock:
+                old = self._cache.pop(name, None)
+                if old is not None:
+                    self._size -= old[3]
+                self._add(name, (template, key, now, size))
+                while self._size > self.max_size and len(self._cache) > 1:
+                    _, (_, _, _, size) = self._cache.popitem(last=False)
+                    self._size -= size
+            event.template = template
+        finally:
+            with self._lock:
+                del self._in_flight[name]
+            event.set()
+        return template
+
+    def render(self, name, context, write):
+        """Render the template file `name`, like `render()`."""
+        self.get_template(name)(context, write)
+
+    def render_iter(self, name, context, buffer_size=8192):
+        """
+        Render the template file `name` by chunks, like `render_iter()`.
+        """
+        return self.get_template(name).render_iter(context, buffer_size)
+
+    def prewarm(self):
+        """
+        Compile every file in the directory now, eg. at startup, so that
+        the first render of each template is not slower. Hidden files and
+        directories (like editor swap files) are skipped.
+        
+        Return a dict of the names of files that could not be loaded to
+        their exception, instead of stopping on the first one.
+        """
+        errors = {}
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                name = os.path.relpath(os.path.join(dirpath, filename),
+                                       self.directory)
+                try:
+                    self.get_template(name)
+                except Exception as exc:
+                    errors[name] = exc
+        return errors
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def benchmark(duration=1):
+    """
+    Print how many renders per second `render()` and `compile_template()`
+    do with a few representative templates.
+    """
+    templates = [
+        ('substitution', 'Hello {name}, you have {count} new messages.',
+         dict(name='World', count=42)),
+        ('loop', '''
+            <ul>{% for item in items %}
+                <li>{item[0]}: {item[1]:.2f}
+                {% if item[1] > 50 %}<strong>big</strong>{% end %}</li>
+            {% end %}</ul>
+        ''', dict(items=[('item %i' % i, i * 1.5) for i in range(100)])),
+        ('nested', '''
+            {% for row in rows %}<tr>{% for cell in row %}<td>{cell}</td>
+            {% end %}</tr>{% end %}
+        ''', dict(rows=[range(10)] * 10)),
+    ]
+    for name, source, context in templates:
+        nodes = parse(source)
+        chunks = []
+        for label, function in [
+                ('render', lambda context, write: render(nodes, context, write)),
+                ('compiled', compile_template(nodes))]:
+            renders = 0
+            start = time.time()
+            while time.time() - start < duration:
+                function(context, chunks.append)
+                del chunks[:]
+                renders += 1
+            print('%s, %s: %.0f renders/s' % (
+                name, label, renders / (time.time() - start)))
+
+    # A big page, where a WSGI app using the write callback has to collect
+    # all fragments before returning them.
+    nodes = parse('''{% for i in items %}<li>{i}</li>
+    {% end %}''')
+    context = dict(items=range(100000))
+    for label, function in [
+            ('render', lambda: render(nodes, context, chunks.append) or chunks),
+            ('compiled', lambda: Template(nodes)(context, chunks.append) or chunks),
+            ('render_iter', lambda: render_iter(nodes, context)),
+            ('compiled render_iter',
+             lambda: Template(nodes).render_iter(context))]:
+        chunks = []
+        start = time.time()
+        writes = 0
+        for chunk in function():
+            if not writes:
+                first_byte = time.time() - start
+            writes += 1
+        print('%s: first byte after %.1f ms, %.1f ms total, %i writes' % (
+            label, first_byte * 1000, (time.time() - start) * 1000, writes))
+
+
 if __name__ == '__main__':
-    import sys
+    if sys.argv[1:] == ['--benchmark']:
+        benchmark()
+        sys.exit()
     render(parse('''
         {foo}
         {% for i in bar %}
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+
+    Compare the speed and memory use of stupid_templates and Jinja2 (as
+    used by jinja2_for_django) on equivalent templates.
+
+    For each template and engine, measure the parse and compile time, the
+    first (cold) and following (warm) render times, the peak memory during
+    a render and the output throughput. Print a summary and optionally
+    write a JSON report:
+
+        python template_benchmarks.py --output report.json
+
+    Jinja2 is optional. jinja2_for_django itself needs a Django project,
+    so a plain `jinja2.Environment` is used instead. Its templates render
+    the same way, minus the flattening of the Django context.
+
+    License: BSD
+
+"""
+
+from __future__ import division
+import sys
+import json
+import time
+import argparse
+
+try:
+    import tracemalloc  # Python 3.4+
+except ImportError:
+    tracemalloc = None
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+import stupid_templates
+
+
+def _big_context():
+    context = dict(('unused_%i' % i, i) for i in range(1000))
+    context.update(title='Big context', items=list(range(100)))
+    return context
+
+
+# name, stupid_templates source, Jinja2 source, context factory
+CASES = [
+    ('substitution',
+     'Hello {name}, you have {count} new messages.',
+     'Hello {{ name }}, you have {{ count }} new messages.',
+     lambda: dict(name='World', count=42)),
+    ('nested_for_if',
+     '{% for row in rows %}<tr>{% for cell in row %}'
+     '{% if cell % 2 %}<td class="odd">{cell}</td>{% end %}'
+     '{% end %}</tr>\n{% end %}',
+     '{% for row in rows %}<tr>{% for cell in row %}'
+     '{% if cell % 2 %}<td class="odd">{{ cell }}</td>{% endif %}'
+     '{% endfor %}</tr>\n{% endfor %}',
+     lambda: dict(rows=[list(range(20))] * 20)),
+    ('large_loop',
+     '<ul>{% for item in items %}<li>{item}</li>\n{% end %}</ul>',
+     '<ul>{% for item in items %}<li>{{ item }}</li>\n{% endfor %}</ul>',
+     lambda: dict(items=list(range(10000)))),
+    ('big_context',
+     '<h1>{title}</h1>{% for item in items %}<p>{item}</p>{% end %}',
+     '<h1>{{ title }}</h1>{% for item in items %}<p>{{ item }}</p>'
+     '{% endfor %}',
+     _big_context),
+]
+
+
+class _Interpreted(object):
+    compile = staticmethod(stupid_templates.parse)
+
+    @staticmethod
+    def render(nodes, context):
+        chunks = []
+        stupid_templates.render(nodes, context, chunks.append)
+        return ''.join(chunks)
+
+
+class _Compiled(object):
+    @staticmethod
+    def compile(source):
+        return stupid_templates.Template(stupid_templates.parse(source))
+
+    @staticmethod
+    def render(template, context):
+        chunks = []
+        template(context, chunks.append)
+        return ''.join(chunks)
+
+
+class _Jinja2(object):
+    def __init__(self):
+        self.env = jinja2.Environment()
+
+    def compile(self, source):
+        return self.env.from_string(source)
+
+    @staticmethod
+    def render(template, context):
+        return template.render(context)
+
+
+def engines():
+    """Return (name, engine, index of the source in CASES) tuples."""
+    result = [('stupid_templates.render', _Interpreted, 1),
+              ('stupid_templates.Template', _Compiled, 1)]
+    if jinja2 is not None:
+        result.append(('jinja2', _Jinja2(), 2))
+    return result
+
+
+def _peak_memory(function):
+    """Return the peak memory allocated while calling `function`, in bytes."""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(engine, source, make_context, duration):
+    """Return a dict of measurements for one template and engine."""
+    compile_times = []
+    for _ in range(5):
+        start = time.time()
+        template = engine.compile(source)
+        compile_times.append(time.time() - start)
+
+    template = engine.compile(source)
+    start = time.time()
+    output = engine.render(template, make_context())
+    cold_render_time = time.time() - start
+
+    context = make_context()
+    renders = 0
+    start = time.time()
+    while time.time() - start < duration:
+        engine.render(template, context)
+        renders += 1
+    warm_time = time.time() - start
+
+    return dict(
+        compile_ms=min(compile_times) * 1000,
+        cold_render_ms=cold_render_time * 1000,
+        warm_render_ms=warm_time / renders * 1000,
+        renders_per_s=renders / warm_time,
+        output_chars=len(output),
+        output_mchars_per_s=len(output) * renders / warm_time / 1e6,
+        peak_memory_bytes=_peak_memory(
+            lambda: engine.render(template, make_context())),
+    )
+
+
+def run(duration=1):
+    """Run all cases with all engines and return the report as a dict."""
+    results = []
+    for case in CASES:
+        name, make_context = case[0], case[3]
+        for engine_name, engine, source_index in engines():
+            result = measure(engine, case[source_index], make_context,
+                             duration)
+            result.update(template=name, engine=engine_name)
+            results.append(result)
+    return dict(
+        python=sys.version.split()[0],
+        jinja2=getattr(jinja2, '__version__', None),
+        duration=duration,
+        results=results,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare stupid_templates and Jinja2.')
+    parser.add_argument(
+        '--duration', type=float, default=1,
+        help='Seconds of warm renders for each measurement. '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--output', metavar='FILE', help='Write a JSON report to FILE.')
+    args = parser.parse_args()
+
+    report = run(args.duration)
+    if report['jinja2'] is None:
+        print('Jinja2 is not installed, only measuring stupid_templates.')
+    print('%-14s %-26s %10s %10s %10s %12s %10s' % (
+        'template', 'engine', 'compile ms', 'cold ms', 'warm ms',
+        'Mchars/s', 'peak KiB'))
+    for result in report['results']:
+        peak = result['peak_memory_bytes']
+        print('%-14s %-26s %10.3f %10.3f %10.3f %12.2f %10s' % (
+            result['template'], result['engine'], result['compile_ms'],
+            result['cold_render_ms'], result['warm_render_ms'],
+            result['output_mchars_per_s'],
+            '-' if peak is None else '%.1f' % (peak / 1024)))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()